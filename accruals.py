@@ -0,0 +1,87 @@
+"""
+Очередь начислений EcoPoints с объединением записей
+
+Начисления (возврат контейнеров, акции) копятся в памяти процесса и уходят
+в БД одной транзакцией раз в flush_interval секунд или сразу, как только
+набралось max_batch штук. Каждый вызов add ждёт свою пачку и получает
+новый баланс пользователя без повторного чтения.
+
+Переменные окружения:
+- ECO_POINTS_FLUSH_INTERVAL — секунд между записями пачки (0.05)
+- ECO_POINTS_MAX_BATCH      — начислений в одной транзакции (500)
+"""
+
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from database import AsyncDatabaseService
+
+logger = logging.getLogger(__name__)
+
+Accrual = Tuple[int, int, str]
+
+
+class EcoPointsCoalescer:
+    """Объединение начислений EcoPoints в пакетные транзакции"""
+
+    def __init__(self, adb: AsyncDatabaseService, flush_interval: float = None, max_batch: int = None):
+        self.adb = adb
+        if flush_interval is None:
+            flush_interval = float(os.getenv("ECO_POINTS_FLUSH_INTERVAL", "0.05"))
+        if max_batch is None:
+            max_batch = int(os.getenv("ECO_POINTS_MAX_BATCH", "500"))
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Accrual, Optional[str], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+
+    async def add(self, telegram_id: int, amount: int, reason: str,
+                  idempotency_key: str = None) -> Optional[int]:
+        """Начислить баллы; возвращает новый баланс или None, если пользователь не найден"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((telegram_id, amount, reason), idempotency_key, future))
+        if len(self._pending) >= self.max_batch or self.flush_interval <= 0:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._schedule_flush)
+        return await future
+
+    def _schedule_flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[Accrual, Optional[str], asyncio.Future]]):
+        try:
+            balances = await self.adb.add_eco_points_bulk(
+                [accrual for accrual, _, _ in batch],
+                [key for _, key, _ in batch],
+            )
+        except Exception as e:
+            logger.error(f"Ошибка записи начислений EcoPoints: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), balance in zip(batch, balances):
+            if not future.done():
+                future.set_result(balance)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def close(self):
+        """Записать накопленные начисления и дождаться записи"""
+        self._schedule_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
@@ -3,14 +3,27 @@ REST API сервис для EcoEats бота
 Используется для веб-интерфейса и интеграций
 """
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional
+import os
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Any, Dict, List, Optional
 from datetime import datetime
-from database import DatabaseService
+from database import DatabaseService, AsyncDatabaseService
+from accruals import EcoPointsCoalescer
+from metrics import DB_PENDING, REGISTRY, MetricsMiddleware
+from export import CONTENT_TYPES, EXPORT_TABLES, STREAM_FORMATS, stream_export
 
 app = FastAPI(title="EcoEats API", version="1.0.0")
-db = DatabaseService(db_path="ecoeats.db")
+db = DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db"))
+# Все эндпоинты работают с БД через пул потоков, не блокируя event loop
+adb = AsyncDatabaseService(db)
+# ECO_POINTS_COALESCE=1: одиночные начисления объединяются в пакетные транзакции
+accruals = EcoPointsCoalescer(adb) if os.getenv("ECO_POINTS_COALESCE", "0").lower() in ("1", "true", "yes") else None
+
+# Метрики запросов и времени БД по обработчикам (GET /metrics)
+app.add_middleware(MetricsMiddleware)
+DB_PENDING.set_function(lambda: adb.pending)
 
 # === PYDANTIC MODELS ===
 
@@ -52,21 +65,51 @@ class OrderOut(BaseModel):
     created_at: datetime
     items: List[OrderItemOut]
 
+class OrderPageOut(BaseModel):
+    items: List[OrderOut]
+    next_cursor: Optional[str]
+
+class OrderItemRequest(BaseModel):
+    dish_id: int
+    quantity: int = Field(1, ge=1)
+    eco_packaging: bool = False
+
 class CreateOrderRequest(BaseModel):
     telegram_id: int
-    items: List[dict]  # [{"dish_id": 1, "quantity": 1, "eco_packaging": True}]
+    items: List[OrderItemRequest]
+
+class BatchOrdersRequest(BaseModel):
+    # Заказы проверяются по одному (CreateOrderRequest), чтобы ошибка в одном
+    # попала в его результат, а не отклонила всю пачку
+    orders: List[Dict[str, Any]] = Field(..., max_length=int(os.getenv("ORDERS_BATCH_MAX", "5000")))
 
 class EcoPointsRequest(BaseModel):
     telegram_id: int
-    amount: int
+    amount: int = Field(..., le=int(os.getenv("ECO_POINTS_MAX_AMOUNT", "10000")))
     reason: str
 
+class EcoPointsBatchRequest(BaseModel):
+    accruals: List[EcoPointsRequest] = Field(..., max_length=int(os.getenv("ECO_POINTS_BATCH_MAX", "5000")))
+
+class LeaderboardEntryOut(BaseModel):
+    rank: int
+    telegram_id: int
+    username: Optional[str]
+    eco_points: int
+
+class UserRankOut(BaseModel):
+    telegram_id: int
+    username: Optional[str]
+    eco_points: int
+    rank: int
+    total_users: int
+
 # === USER ENDPOINTS ===
 
 @app.get("/api/users/{telegram_id}", response_model=UserOut)
 async def get_user(telegram_id: int):
     """Получить информацию о пользователе"""
-    user = db.get_user(telegram_id)
+    user = await adb.get_user(telegram_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
@@ -74,13 +117,13 @@ async def get_user(telegram_id: int):
 @app.post("/api/users/{telegram_id}/{username}")
 async def create_user(telegram_id: int, username: str):
     """Создать или получить пользователя"""
-    user = db.get_or_create_user(telegram_id, username)
-    return {"status": "ok", "user_id": user.id}
+    user = await adb.get_or_create_user(telegram_id, username)
+    return {"status": "ok", "user_id": user["id"]}
 
 @app.get("/api/users/{telegram_id}/stats")
 async def get_user_stats(telegram_id: int):
     """Получить статистику пользователя"""
-    stats = db.get_user_stats(telegram_id)
+    stats = await adb.get_user_stats(telegram_id)
     if not stats:
         raise HTTPException(status_code=404, detail="User not found")
     return stats
@@ -90,13 +133,13 @@ async def get_user_stats(telegram_id: int):
 @app.get("/api/restaurants", response_model=List[RestaurantOut])
 async def get_restaurants():
     """Получить все рестораны"""
-    restaurants = db.get_restaurants()
+    restaurants = await adb.get_restaurants()
     return restaurants
 
 @app.get("/api/restaurants/{restaurant_id}", response_model=RestaurantOut)
 async def get_restaurant(restaurant_id: int):
     """Получить информацию о ресторане"""
-    restaurant = db.get_restaurant(restaurant_id)
+    restaurant = await adb.get_restaurant(restaurant_id)
     if not restaurant:
         raise HTTPException(status_code=404, detail="Restaurant not found")
     return restaurant
@@ -106,13 +149,13 @@ async def get_restaurant(restaurant_id: int):
 @app.get("/api/restaurants/{restaurant_id}/dishes", response_model=List[DishOut])
 async def get_dishes(restaurant_id: int):
     """Получить меню ресторана"""
-    dishes = db.get_dishes(restaurant_id)
+    dishes = await adb.get_dishes(restaurant_id)
     return dishes
 
 @app.get("/api/dishes/{dish_id}", response_model=DishOut)
 async def get_dish(dish_id: int):
     """Получить информацию о блюде"""
-    dish = db.get_dish(dish_id)
+    dish = await adb.get_dish(dish_id)
     if not dish:
         raise HTTPException(status_code=404, detail="Dish not found")
     return dish
@@ -120,34 +163,140 @@ async def get_dish(dish_id: int):
 # === ORDER ENDPOINTS ===
 
 @app.post("/api/orders")
-async def create_order(request: CreateOrderRequest):
-    """Создать новый заказ"""
+async def create_order(request: CreateOrderRequest,
+                       idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=128)):
+    """Создать новый заказ
+    Повтор запроса с тем же заголовком Idempotency-Key возвращает исходный заказ
+    """
     try:
-        order = db.create_order(request.telegram_id, request.items)
+        items = [item.model_dump() for item in request.items]
+        order = await adb.create_order(request.telegram_id, items, idempotency_key)
         return {
             "status": "ok",
             "order_id": order.id,
             "total_amount": order.total_amount,
             "eco_fee_total": order.eco_fee_total,
-            "eco_points_earned": sum(1 for item in request.items if item.get("eco_packaging")) * 10
+            "eco_points_earned": sum(1 for item in request.items if item.eco_packaging) * 10
         }
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/api/orders/batch")
+async def create_orders_batch(request: BatchOrdersRequest):
+    """Создать пачку заказов (интеграции партнёров)
+    Все заказы пишутся одной транзакцией; ошибочные не мешают остальным
+    и возвращаются в results со статусом "error".
+    """
+    results: List[Optional[dict]] = [None] * len(request.orders)
+    valid = []  # (индекс во входной пачке, заказ)
+    for index, raw in enumerate(request.orders):
+        try:
+            valid.append((index, CreateOrderRequest.model_validate(raw).model_dump()))
+        except ValidationError as e:
+            error = e.errors()[0]
+            location = ".".join(str(part) for part in error["loc"])
+            results[index] = {"index": index, "status": "error", "error": f"{location}: {error['msg']}"}
+    if valid:
+        for (index, _), result in zip(valid, await adb.create_orders_bulk([order for _, order in valid])):
+            results[index] = {**result, "index": index}
+    created = sum(1 for result in results if result["status"] == "ok")
+    return {
+        "status": "ok",
+        "created": created,
+        "failed": len(results) - created,
+        "results": results
+    }
+
+@app.get("/api/users/{telegram_id}/orders", response_model=OrderPageOut)
+async def get_user_orders(telegram_id: int, limit: int = Query(20, ge=1, le=100), cursor: Optional[str] = None):
+    """История заказов пользователя (от новых к старым)
+    Следующая страница: ?cursor=<next_cursor>
+    """
+    try:
+        page = await adb.get_user_orders(telegram_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return page
+
 # === ECO POINTS ENDPOINTS ===
 
 @app.post("/api/eco-points/add")
-async def add_eco_points(request: EcoPointsRequest):
-    """Добавить экопоинты пользователю"""
-    db.add_eco_points(request.telegram_id, request.amount, request.reason)
-    user = db.get_user(request.telegram_id)
-    if not user:
+async def add_eco_points(request: EcoPointsRequest,
+                         idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=128)):
+    """Добавить экопоинты пользователю
+    Повтор запроса с тем же заголовком Idempotency-Key не начисляет баллы заново
+    """
+    if accruals:
+        balance = await accruals.add(request.telegram_id, request.amount, request.reason, idempotency_key)
+    else:
+        balance = await adb.add_eco_points(request.telegram_id, request.amount, request.reason,
+                                           idempotency_key)
+    if balance is None:
         raise HTTPException(status_code=404, detail="User not found")
     return {
         "status": "ok",
-        "total_eco_points": user.eco_points
+        "total_eco_points": balance
+    }
+
+@app.post("/api/eco-points/batch")
+async def add_eco_points_batch(request: EcoPointsBatchRequest):
+    """Начислить экопоинты многим пользователям одной транзакцией
+    В results — новый баланс для каждого начисления (null: пользователь не найден)
+    """
+    balances = await adb.add_eco_points_bulk([
+        (accrual.telegram_id, accrual.amount, accrual.reason) for accrual in request.accruals
+    ])
+    return {
+        "status": "ok",
+        "credited": sum(1 for balance in balances if balance is not None),
+        "results": [
+            {"telegram_id": accrual.telegram_id, "total_eco_points": balance}
+            for accrual, balance in zip(request.accruals, balances)
+        ]
     }
 
+@app.on_event("shutdown")
+async def shutdown_db_executor():
+    """Дождаться завершения запросов к БД при остановке"""
+    if accruals:
+        await accruals.close()
+    adb.close()
+
+# === LEADERBOARD ENDPOINTS ===
+
+@app.get("/api/leaderboard", response_model=List[LeaderboardEntryOut])
+async def get_leaderboard(limit: int = Query(10, ge=1, le=100)):
+    """Топ пользователей по EcoPoints"""
+    return await adb.get_leaderboard(limit)
+
+@app.get("/api/users/{telegram_id}/rank", response_model=UserRankOut)
+async def get_user_rank(telegram_id: int):
+    """Место пользователя в рейтинге EcoPoints"""
+    rank = await adb.get_user_rank(telegram_id)
+    if not rank:
+        raise HTTPException(status_code=404, detail="User not found")
+    return rank
+
+# === EXPORT ENDPOINTS ===
+
+@app.get("/api/export/{table}")
+async def export_table(table: str, format: str = "ndjson", chunk_size: int = Query(1000, ge=1, le=50000)):
+    """Потоковая выгрузка orders / order_items / eco_points в NDJSON или CSV
+    Строки читаются из БД порциями, память не зависит от объёма выгрузки.
+    """
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Unknown table")
+    if format not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(STREAM_FORMATS)}")
+    # Синхронный генератор Starlette итерирует в пуле потоков, event loop не блокируется
+    return StreamingResponse(
+        stream_export(db.engine, table, format, chunk_size),
+        media_type=CONTENT_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
 # === HEALTH CHECK ===
 
 @app.get("/api/health")
@@ -159,6 +308,11 @@ async def health_check():
         "version": "1.0.0"
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
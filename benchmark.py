@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки горячих путей DatabaseService
+
+Запуск:
+    python benchmark.py checkout [--orders 200] [--profile]
+    python benchmark.py hotpaths [--scale 1k|100k|1m] [--seed 42] [--ops 1000]
+                                 [--db-path bench.db | --db-url URL] [--out result.json]
+
+hotpaths заполняет БД синтетическими пользователями и заказами (одинаковыми
+при одном и том же --seed) и измеряет get_or_create_user, get_dishes,
+create_order, add_eco_points и get_user_stats: операций в секунду и
+перцентили задержки. С --db-path набор данных сохраняется и при повторном
+запуске с теми же --scale и --seed не генерируется заново.
+
+Результат печатается в формате JSON (или пишется в --out).
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import sessionmaker
+
+from database import DatabaseService
+from models import Order, OrderItem, User
+from profiling import QueryProfiler, percentile, profile_service
+
+SCALES = {
+    "1k": {"users": 1_000, "orders": 1_000},
+    "100k": {"users": 100_000, "orders": 100_000},
+    "1m": {"users": 1_000_000, "orders": 1_000_000},
+}
+HOTPATH_OPERATIONS = ("get_or_create_user", "get_dishes", "create_order", "add_eco_points", "get_user_stats")
+SEED_CHUNK = 10_000
+DATASET_KEY = "bench:dataset"
+
+
+def bench_checkout(db: DatabaseService, orders: int, cart_sizes=(1, 5, 20, 100)) -> list:
+    """Число запросов и время на один create_order для корзин разного размера
+    Ожидается 7 запросов на заказ при любом размере корзины: пользователь,
+    блюда (IN), заказ, позиции (пакетный INSERT), баланс, запись EcoPoints,
+    user_stats (первый заказ пользователя добавляет ещё три на создание user_stats).
+    """
+    counter = QueryProfiler(db.engine)
+    dish_ids = [dish.id for dish in db.get_menu().dishes]
+    db.get_or_create_user(1, "bench")
+
+    results = []
+    for cart_size in cart_sizes:
+        items = [
+            {"dish_id": dish_ids[i % len(dish_ids)], "quantity": 1, "eco_packaging": i % 2 == 0}
+            for i in range(cart_size)
+        ]
+        counter.reset()
+        started = time.perf_counter()
+        for _ in range(orders):
+            db.create_order(1, items)
+        elapsed = time.perf_counter() - started
+        results.append({
+            "cart_size": cart_size,
+            "orders": orders,
+            "statements_per_order": counter.statement_count / orders,
+            "ms_per_order": elapsed * 1000 / orders,
+        })
+    counter.close()
+    return results
+
+
+# === СИНТЕТИЧЕСКИЕ ДАННЫЕ ===
+def _insert_returning_ids(session, model, rows) -> list:
+    """Пакетный INSERT; id в порядке строк (как в DatabaseService.create_orders_bulk)"""
+    return session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows).all()
+
+
+def seed_dataset(db: DatabaseService, users: int, orders: int, seed: int) -> dict:
+    """Заполнить БД пользователями и заказами (детерминированно по seed)
+    Возвращает описание набора данных; повторный вызов с теми же параметрами
+    ничего не делает.
+    """
+    dataset = {"users": users, "orders": orders, "seed": seed}
+    marker = db.kv_get_many([DATASET_KEY]).get(DATASET_KEY)
+    if marker:
+        existing = json.loads(marker)
+        if {key: existing.get(key) for key in dataset} == dataset:
+            return {**existing, "seed_seconds": 0.0, "reused": True}
+        raise ValueError(f"БД уже содержит другой набор данных: {existing}")
+
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    dishes = [(dish.id, dish.price) for dish in db.get_menu().dishes]
+    base_time = datetime(2024, 1, 1)
+    session = db.get_session()
+
+    user_ids = []
+    for start in range(0, users, SEED_CHUNK):
+        rows = [
+            {"telegram_id": 10_000_000 + i, "username": f"user{i}", "eco_points": 0, "orders_count": 0,
+             "created_at": base_time}
+            for i in range(start, min(start + SEED_CHUNK, users))
+        ]
+        user_ids.extend(_insert_returning_ids(session, User, rows))
+        session.commit()
+
+    orders_count = {}
+    eco_points = {}
+    for start in range(0, orders, SEED_CHUNK):
+        order_rows = []
+        carts = []
+        for _ in range(min(SEED_CHUNK, orders - start)):
+            user_id = user_ids[rng.randrange(users)]
+            cart = [(dish, rng.random() < 0.5) for dish in rng.choices(dishes, k=rng.randint(1, 3))]
+            eco_items = sum(1 for _, eco in cart if eco)
+            order_rows.append({
+                "user_id": user_id,
+                "total_amount": sum(price for (_, price), _ in cart),
+                "eco_fee_total": 150 * eco_items,
+                "status": "completed",
+                "created_at": base_time + timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+            })
+            carts.append(cart)
+            orders_count[user_id] = orders_count.get(user_id, 0) + 1
+            eco_points[user_id] = eco_points.get(user_id, 0) + eco_items * 10
+        order_ids = _insert_returning_ids(session, Order, order_rows)
+        session.execute(insert(OrderItem), [
+            {"order_id": order_id, "dish_id": dish_id, "quantity": 1, "price": price,
+             "eco_packaging": eco, "eco_fee": 150 if eco else 0}
+            for order_id, cart in zip(order_ids, carts)
+            for (dish_id, price), eco in cart
+        ])
+        session.commit()
+
+    counters = [
+        {"user_pk": user_id, "eco_points": eco_points[user_id], "orders_count": count}
+        for user_id, count in orders_count.items()
+    ]
+    stmt = (
+        update(User.__table__)
+        .where(User.__table__.c.id == bindparam("user_pk"))
+        .values(eco_points=bindparam("eco_points"), orders_count=bindparam("orders_count"))
+    )
+    for start in range(0, len(counters), SEED_CHUNK):
+        session.execute(stmt, counters[start:start + SEED_CHUNK])
+    session.commit()
+    session.close()
+
+    db.rebuild_user_stats()
+    db.leaderboard.invalidate()
+    db.kv_write_many({DATASET_KEY: json.dumps(dataset)})
+    return {**dataset, "seed_seconds": round(time.perf_counter() - started, 2), "reused": False}
+
+
+@contextmanager
+def scratch_database(db: DatabaseService):
+    """БД для замеров, изменения в которой не попадают в сохранённый набор данных
+    SQLite копируется через backup API (pysqlite не поддерживает SAVEPOINT без
+    перенастройки движка), для остальных СУБД сессии работают в точках
+    сохранения внутри внешней транзакции, которая в конце откатывается.
+    """
+    if db.engine.dialect.name == "sqlite":
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "scratch.db")
+            source = db.engine.raw_connection()
+            target = sqlite3.connect(path)
+            try:
+                source.driver_connection.backup(target)
+            finally:
+                target.close()
+                source.close()
+            scratch = DatabaseService(db_path=path)
+            try:
+                yield scratch
+            finally:
+                scratch.engine.dispose()
+        return
+
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    session_factory = db.SessionLocal
+    db.SessionLocal = sessionmaker(bind=connection, expire_on_commit=False, join_transaction_mode="create_savepoint")
+    try:
+        yield db
+    finally:
+        db.SessionLocal = session_factory
+        transaction.rollback()
+        connection.close()
+        db.leaderboard.invalidate()
+
+
+# === ИЗМЕРЕНИЯ ===
+def measure(operation, ops: int) -> dict:
+    """Выполнить operation(i) ops раз; операции в секунду и перцентили в мс"""
+    latencies = []
+    started = time.perf_counter()
+    for i in range(ops):
+        op_started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": ops,
+        "ops_per_sec": round(ops / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+def bench_hotpaths(db: DatabaseService, dataset: dict, ops: int, seed: int,
+                   operations=HOTPATH_OPERATIONS) -> dict:
+    """Горячие пути на заполненной БД; нагрузка тоже детерминирована по seed"""
+    rng = random.Random(seed + 1)
+    users = dataset["users"]
+    restaurant_ids = [restaurant.id for restaurant in db.get_menu().restaurants]
+    dish_ids = [dish.id for dish in db.get_menu().dishes]
+
+    def telegram_id() -> int:
+        return 10_000_000 + rng.randrange(users)
+
+    scenarios = {
+        "get_or_create_user": lambda i: db.get_or_create_user(telegram_id(), None),
+        "get_dishes": lambda i: db.get_dishes(rng.choice(restaurant_ids)),
+        "create_order": lambda i: db.create_order(telegram_id(), [
+            {"dish_id": rng.choice(dish_ids), "quantity": 1, "eco_packaging": rng.random() < 0.5}
+            for _ in range(rng.randint(1, 5))
+        ]),
+        "add_eco_points": lambda i: db.add_eco_points(telegram_id(), 5, "container_return"),
+        "get_user_stats": lambda i: db.get_user_stats(telegram_id()),
+    }
+    return {name: measure(scenarios[name], ops) for name in operations}
+
+
+def run_hotpaths(args) -> dict:
+    scale = dict(SCALES[args.scale])
+    if args.users:
+        scale["users"] = args.users
+    if args.orders:
+        scale["orders"] = args.orders
+
+    def run(db: DatabaseService) -> dict:
+        dataset = seed_dataset(db, scale["users"], scale["orders"], args.seed)
+        with scratch_database(db) as scratch:
+            return {
+                "scenario": "hotpaths",
+                "scale": args.scale,
+                "dataset": dataset,
+                "environment": {
+                    "python": platform.python_version(),
+                    "sqlalchemy": sqlalchemy.__version__,
+                    "dialect": db.engine.dialect.name,
+                    "platform": platform.platform(),
+                },
+                "operations": bench_hotpaths(scratch, dataset, args.ops, args.seed, args.operations),
+            }
+
+    if args.db_url or args.db_path:
+        db = DatabaseService(db_path=args.db_path or "bench.db", db_url=args.db_url)
+        try:
+            return run(db)
+        finally:
+            db.engine.dispose()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseService(db_path=os.path.join(tmp, "bench.db"))
+        try:
+            return run(db)
+        finally:
+            db.engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки DatabaseService")
+    parser.add_argument("scenario", choices=["checkout", "hotpaths"])
+    parser.add_argument("--orders", type=int, default=None,
+                        help="checkout: заказов на каждый размер корзины (200); hotpaths: заказов в наборе данных")
+    parser.add_argument("--profile", action="store_true",
+                        help="Добавить в отчёт запросы по методам и подозрения на N+1")
+    parser.add_argument("--scale", choices=list(SCALES), default="1k", help="Размер набора данных (hotpaths)")
+    parser.add_argument("--users", type=int, default=None, help="Пользователей в наборе данных (вместо --scale)")
+    parser.add_argument("--seed", type=int, default=42, help="Зерно генератора данных и нагрузки")
+    parser.add_argument("--ops", type=int, default=1000, help="Операций на каждый горячий путь")
+    parser.add_argument("--operations", nargs="+", choices=HOTPATH_OPERATIONS, default=list(HOTPATH_OPERATIONS))
+    parser.add_argument("--db-path", help="SQLite-файл для набора данных (переиспользуется между запусками)")
+    parser.add_argument("--db-url", help="URL БД (например, PostgreSQL) вместо временного SQLite")
+    parser.add_argument("--out", help="Записать JSON в файл вместо stdout")
+    args = parser.parse_args(argv)
+
+    if args.scenario == "hotpaths":
+        report = run_hotpaths(args)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DatabaseService(db_path=os.path.join(tmp, "bench.db"))
+            if args.profile and db.profiler is None:
+                db.profiler = profile_service(db)
+            report = {"checkout": bench_checkout(db, args.orders or 200)}
+            if args.profile:
+                report["profile"] = db.profiler.report()
+            db.engine.dispose()
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ Результат записан в {args.out}")
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Метрики обработчиков бота EcoEats
+
+HandlerMetricsMiddleware (aiogram, внутренний middleware роутера) для каждого
+обработчика считает время, время в БД и ошибки. TelegramAPITimingMiddleware
+(middleware сессии бота) измеряет запросы к Bot API по методам и по
+обработчикам: запросы из очереди исходящих (outbox.py) отправляются в
+контексте поставившего их обработчика и учитываются ему же. Метрики отдаются в формате Prometheus
+(GET /metrics в webhook-режиме или на BOT_METRICS_PORT при polling) и
+периодически пишутся в лог сводкой.
+
+Переменные окружения:
+- BOT_METRICS_LOG_INTERVAL — секунд между сводками в логе (60; 0 — выключено)
+- BOT_METRICS_HOST/PORT    — адрес HTTP-сервера /metrics в режиме polling
+                             (без BOT_METRICS_PORT сервер не запускается)
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+
+from metrics import (
+    DB_PENDING, REGISTRY, Counter, Gauge, Histogram, db_time_scope, estimate_quantile,
+)
+
+logger = logging.getLogger(__name__)
+
+BOT_HANDLER_SECONDS = Histogram(
+    "ecoeats_bot_handler_duration_seconds",
+    "Время обработчика бота",
+    ["handler"],
+)
+BOT_HANDLER_DB_SECONDS = Histogram(
+    "ecoeats_bot_handler_db_seconds",
+    "Время в БД за один вызов обработчика",
+    ["handler"],
+)
+BOT_HANDLER_API_SECONDS = Histogram(
+    "ecoeats_bot_handler_telegram_request_seconds",
+    "Время запроса к Telegram API от обработчика, включая отправленные очередью исходящих",
+    ["handler"],
+)
+BOT_HANDLER_ERRORS = Counter(
+    "ecoeats_bot_handler_errors_total",
+    "Исключения, вышедшие из обработчика",
+    ["handler"],
+)
+BOT_UPDATES_IN_FLIGHT = Gauge(
+    "ecoeats_bot_updates_in_flight",
+    "Апдейтов в обработке",
+)
+CART_STORE = Gauge(
+    "ecoeats_cart_store",
+    "Хранилище корзин: записи, буфер и вытеснения (stat=entries, pending_writes, hits, misses, evicted_lru, "
+    "evicted_ttl; счётчики вытеснений есть только у STORAGE_BACKEND=memory)",
+    ["stat"],
+)
+BOT_API_SECONDS = Histogram(
+    "ecoeats_bot_api_request_duration_seconds",
+    "Время запроса к Telegram Bot API по методу",
+    ["method"],
+)
+# Обработчик, от имени которого идут запросы к Bot API
+CURRENT_HANDLER: ContextVar[Optional[str]] = ContextVar("ecoeats_bot_handler", default=None)
+
+
+def handler_name(data: Dict[str, Any]) -> str:
+    """Имя функции обработчика из данных внутреннего middleware"""
+    handler = data.get("handler")
+    return getattr(getattr(handler, "callback", None), "__name__", None) or "unknown"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время, время БД и ошибки по обработчикам"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = handler_name(data)
+        BOT_UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        token = CURRENT_HANDLER.set(name)
+        try:
+            with db_time_scope() as db_time:
+                return await handler(event, data)
+        except Exception:
+            BOT_HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            CURRENT_HANDLER.reset(token)
+            BOT_UPDATES_IN_FLIGHT.dec()
+            BOT_HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+            BOT_HANDLER_DB_SECONDS.labels(name).observe(db_time[0])
+
+
+class TelegramAPITimingMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API по методам и по обработчикам"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            BOT_API_SECONDS.labels(type(method).__name__).observe(elapsed)
+            handler = CURRENT_HANDLER.get()
+            if handler is not None:
+                BOT_HANDLER_API_SECONDS.labels(handler).observe(elapsed)
+
+
+def setup_bot_metrics(router: Router, bot: Bot, db=None, carts=None):
+    """Подключить метрики к роутеру и сессии бота
+    db: AsyncDatabaseService — для метрики очереди вызовов БД
+    carts: CartStore — для метрики хранилища корзин
+    """
+    middleware = HandlerMetricsMiddleware()
+    router.message.middleware(middleware)
+    router.callback_query.middleware(middleware)
+    bot.session.middleware(TelegramAPITimingMiddleware())
+    if db is not None:
+        DB_PENDING.set_function(lambda: db.pending)
+    if carts is not None:
+        CART_STORE.set_function(carts.stats)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """HTTP-сервер только с /metrics (режим polling)"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики бота: http://{host}:{port}/metrics")
+    return runner
+
+
+# === СВОДКА В ЛОГ ===
+class MetricsReporter:
+    """Периодическая сводка по обработчикам за прошедший интервал"""
+
+    def __init__(self, interval: float = None):
+        if interval is None:
+            interval = float(os.getenv("BOT_METRICS_LOG_INTERVAL", "60"))
+        self.interval = interval
+        self._last: Dict[str, Tuple[List[int], float, int]] = {}
+        self._last_errors: Dict[str, float] = {}
+        self._last_db: Dict[str, float] = {}
+        self._last_api: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _sums(histogram: Histogram) -> Dict[str, float]:
+        return {values[0]: child.sum for values, child in histogram.items()}
+
+    def summary(self) -> List[str]:
+        """Строки сводки: обработчики, вызванные с прошлой сводки, от медленных к быстрым"""
+        errors = {values[0]: child.value for values, child in BOT_HANDLER_ERRORS.items()}
+        db_sums = self._sums(BOT_HANDLER_DB_SECONDS)
+        api_sums = self._sums(BOT_HANDLER_API_SECONDS)
+
+        rows = []
+        for (name,), child in BOT_HANDLER_SECONDS.items():
+            counts, total, count = child.snapshot()
+            last_counts, last_total, last_count = self._last.get(name, ([0] * len(counts), 0.0, 0))
+            self._last[name] = (counts, total, count)
+            calls = count - last_count
+            if not calls:
+                continue
+            delta = [now - before for now, before in zip(counts, last_counts)]
+            db_delta = db_sums.get(name, 0.0) - self._last_db.get(name, 0.0)
+            api_delta = api_sums.get(name, 0.0) - self._last_api.get(name, 0.0)
+            error_delta = errors.get(name, 0) - self._last_errors.get(name, 0)
+            rows.append((
+                total - last_total,
+                f"{name}: {calls} вызовов, "
+                f"p50 ≤{estimate_quantile(child.buckets, delta, 0.5)} с, "
+                f"p95 ≤{estimate_quantile(child.buckets, delta, 0.95)} с, "
+                f"в среднем {(total - last_total) / calls * 1000:.1f} мс "
+                f"(БД {db_delta / calls * 1000:.1f} мс, Telegram {api_delta / calls * 1000:.1f} мс), "
+                f"ошибок {int(error_delta)}",
+            ))
+        self._last_db, self._last_api, self._last_errors = db_sums, api_sums, errors
+
+        rows.sort(key=lambda row: row[0], reverse=True)
+        lines = [line for _, line in rows]
+        lines.append(f"в работе апдейтов: {int(BOT_UPDATES_IN_FLIGHT.get())}, "
+                     f"вызовов БД в очереди: {int(DB_PENDING.get())}")
+        return lines
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            lines = self.summary()
+            if len(lines) > 1:
+                logger.info("📊 Обработчики за %.0f с:\n  %s", self.interval, "\n  ".join(lines))
+
+    def start(self):
+        """Запустить периодическую сводку"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._report_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
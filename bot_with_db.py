@@ -5,10 +5,16 @@ from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
 from dotenv import load_dotenv
-from database import DatabaseService
+from database import DatabaseService, AsyncDatabaseService
+from accruals import EcoPointsCoalescer
+from bot_metrics import MetricsReporter, setup_bot_metrics, start_metrics_server
+from keyboards import KeyboardRegistry
+from broadcast import BroadcastRunner
+from outbox import Outbox
+from storage import CartStore, KVStorage, create_backend
+from webhook import run_webhook
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -22,14 +28,35 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден! Создайте файл .env и добавьте токен.")
 
+# Инициализация БД: все запросы выполняются в пуле потоков, чтобы оформление
+# заказов не блокировало обработку апдейтов (DB_EXECUTOR_WORKERS, DB_MAX_PENDING)
+db = AsyncDatabaseService(DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db")))
+
+# Корзины и FSM-состояния хранятся вне процесса (STORAGE_BACKEND), поэтому
+# можно запускать несколько воркеров и перезапускать бота без потери корзин
+storage_backend = create_backend(db)
+carts = CartStore(storage_backend)
+# Начисления за возврат контейнеров пишутся пачками (ECO_POINTS_FLUSH_INTERVAL)
+accruals = EcoPointsCoalescer(db)
+
 # Инициализация
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = KVStorage(storage_backend)
 dp = Dispatcher(storage=storage)
 router = Router()
 
-# Инициализация БД
-db = DatabaseService(db_path="ecoeats.db")
+# Время обработчиков, БД и Telegram API (/metrics и сводка в логе)
+setup_bot_metrics(router, bot, db, carts)
+metrics_reporter = MetricsReporter()
+
+# Ответы, правки сообщений и ответы на нажатия кнопок уходят через очередь с
+# лимитами Telegram (OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE): обработчики не ждут
+# Bot API и не упираются в 429, а несколько правок одного сообщения склеиваются в одну
+outbox = Outbox(bot)
+
+# Рассылки (manage.py broadcast send) отправляет бот через ту же очередь:
+# лимит Telegram общий на бота, ответы пользователям идут вне очереди рассылки
+broadcasts = BroadcastRunner(db, outbox)
 
 # Состояния FSM
 class OrderStates(StatesGroup):
@@ -38,87 +65,61 @@ class OrderStates(StatesGroup):
     choosing_packaging = State()
     viewing_cart = State()
 
-# Глобальная корзина пользователя (хранится в памяти во время сеанса)
-user_carts = {}
-
-def get_user_cart(user_id: int):
-    """Получить корзину пользователя"""
-    if user_id not in user_carts:
-        user_carts[user_id] = []
-    return user_carts[user_id]
-
-def clear_user_cart(user_id: int):
+async def get_user_cart(user_id: int):
+    """Получить корзину пользователя с названиями и ценами из меню"""
+    cart_items = await carts.get(user_id)
+    if not cart_items:
+        return []
+    snapshot = await db.get_menu()
+    cart = []
+    for dish_id, eco_packaging in cart_items:
+        dish = snapshot.dishes_by_id.get(dish_id)
+        if not dish:
+            continue
+        cart.append({
+            "dish_id": dish_id,
+            "dish_name": dish.name,
+            "price": dish.price,
+            "eco_packaging": eco_packaging,
+            "eco_fee": 150 if eco_packaging else 0
+        })
+    return cart
+
+async def clear_user_cart(user_id: int):
     """Очистить корзину пользователя"""
-    if user_id in user_carts:
-        user_carts[user_id] = []
+    await carts.clear(user_id)
 
 # === КЛАВИАТУРЫ ===
+# Клавиатуры строятся один раз (меню — один раз на версию снимка меню)
+keyboards = KeyboardRegistry()
+
 def get_main_menu_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(text="🍔 Меню ресторанов", callback_data="menu_restaurants")],
-        [InlineKeyboardButton(text="🛒 Корзина", callback_data="view_cart")],
-        [InlineKeyboardButton(text="🌿 Мои бонусы", callback_data="my_bonus")],
-        [InlineKeyboardButton(text="🔄 Возврат контейнеров", callback_data="return_containers")],
-        [InlineKeyboardButton(text="ℹ️ О сервисе", callback_data="about_service")],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-def get_restaurants_keyboard() -> InlineKeyboardMarkup:
-    restaurants = db.get_restaurants()
-    keyboard = []
-    for rest in restaurants:
-        keyboard.append([InlineKeyboardButton(
-            text=f"{rest.emoji} {rest.name}",
-            callback_data=f"rest|{rest.id}"
-        )])
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-def get_dishes_keyboard(restaurant_id: int) -> InlineKeyboardMarkup:
-    dishes = db.get_dishes(restaurant_id)
-    keyboard = []
-    for dish in dishes:
-        keyboard.append([InlineKeyboardButton(
-            text=f"{dish.name} – {dish.price}₸",
-            callback_data=f"dish|{restaurant_id}|{dish.id}"
-        )])
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад к ресторанам", callback_data="menu_restaurants")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-def get_packaging_keyboard(restaurant_id: int, dish_id: int) -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(text="♻️ Да, в экоупаковке (+150₸)", 
-                            callback_data=f"pack|eco|{restaurant_id}|{dish_id}")],
-        [InlineKeyboardButton(text="❌ Нет, обычная упаковка", 
-                            callback_data=f"pack|regular|{restaurant_id}|{dish_id}")],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return keyboards.main_menu
+
+async def get_restaurants_keyboard() -> InlineKeyboardMarkup:
+    return keyboards.restaurants(await db.get_menu())
+
+async def get_dishes_keyboard(restaurant_id: int) -> InlineKeyboardMarkup:
+    return keyboards.dishes(await db.get_menu(), restaurant_id)
+
+async def get_packaging_keyboard(restaurant_id: int, dish_id: int) -> InlineKeyboardMarkup:
+    return keyboards.packaging(await db.get_menu(), restaurant_id, dish_id)
 
 def get_after_add_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(text="➕ Добавить ещё", callback_data="menu_restaurants")],
-        [InlineKeyboardButton(text="🛒 Перейти в корзину", callback_data="view_cart")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return keyboards.after_add
 
 def get_cart_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(text="✔️ Оформить заказ", callback_data="checkout")],
-        [InlineKeyboardButton(text="❌ Очистить корзину", callback_data="clear_cart")],
-        [InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_main")],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return keyboards.cart
 
 def get_back_button() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton(text="🔙 Главное меню", callback_data="back_to_main")]]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return keyboards.back
 
 # === ОБРАБОТЧИКИ КОМАНД ===
 @router.message(Command("start"))
 async def cmd_start(message: Message):
-    user = db.get_or_create_user(message.from_user.id, message.from_user.username)
-    await message.answer(
+    user = await db.get_or_create_user(message.from_user.id, message.from_user.username)
+    outbox.answer(
+        message,
         "🌱 <b>Добро пожаловать в EcoEats!</b>\n\n"
         "Экологичная доставка еды 🌿\n"
         "Выберите действие:",
@@ -128,7 +129,8 @@ async def cmd_start(message: Message):
 
 @router.message(Command("menu"))
 async def cmd_menu(message: Message):
-    await message.answer(
+    outbox.answer(
+        message,
         "🌱 <b>Главное меню EcoEats</b>\n\n"
         "Выберите действие:",
         reply_markup=get_main_menu_keyboard(),
@@ -146,42 +148,42 @@ async def cmd_bonus(message: Message):
 # === ОБРАБОТЧИКИ КНОПОК ===
 @router.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: CallbackQuery):
-    try:
-        await callback.message.edit_text(
-            "🌱 <b>Главное меню EcoEats</b>\n\n"
-            "Выберите действие:",
-            reply_markup=get_main_menu_keyboard(),
-            parse_mode="HTML"
-        )
-    except Exception:
-        pass
-    await callback.answer()
+    outbox.edit_text(
+        callback.message,
+        "🌱 <b>Главное меню EcoEats</b>\n\n"
+        "Выберите действие:",
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode="HTML"
+    )
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data == "menu_restaurants")
 async def show_restaurants(callback: CallbackQuery):
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         "🍽 <b>Выберите ресторан:</b>",
-        reply_markup=get_restaurants_keyboard(),
+        reply_markup=await get_restaurants_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data.startswith("rest|"))
 async def show_restaurant_menu(callback: CallbackQuery):
     restaurant_id = int(callback.data.split("|")[1])
-    restaurant = db.get_restaurant(restaurant_id)
+    restaurant = await db.get_restaurant(restaurant_id)
     
     if not restaurant:
-        await callback.answer("Ресторан не найден", show_alert=True)
+        outbox.answer_callback(callback, "Ресторан не найден", show_alert=True)
         return
     
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         f"🍽 <b>{restaurant.emoji} {restaurant.name}</b>\n\n"
         "Выберите блюдо:",
-        reply_markup=get_dishes_keyboard(restaurant_id),
+        reply_markup=await get_dishes_keyboard(restaurant_id),
         parse_mode="HTML"
     )
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data.startswith("dish|"))
 async def choose_dish(callback: CallbackQuery):
@@ -189,20 +191,21 @@ async def choose_dish(callback: CallbackQuery):
     restaurant_id = int(parts[1])
     dish_id = int(parts[2])
     
-    dish = db.get_dish(dish_id)
+    dish = await db.get_dish(dish_id)
     if not dish:
-        await callback.answer("Блюдо не найдено", show_alert=True)
+        outbox.answer_callback(callback, "Блюдо не найдено", show_alert=True)
         return
     
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         f"🍽 <b>{dish.name}</b>\n"
         f"💰 Цена: {dish.price}₸\n"
         f"📝 {dish.description or ''}\n\n"
         "Добавить в экоупаковке? (+150₸)",
-        reply_markup=get_packaging_keyboard(restaurant_id, dish_id),
+        reply_markup=await get_packaging_keyboard(restaurant_id, dish_id),
         parse_mode="HTML"
     )
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data.startswith("pack|"))
 async def add_to_cart(callback: CallbackQuery):
@@ -211,26 +214,20 @@ async def add_to_cart(callback: CallbackQuery):
     restaurant_id = int(parts[2])
     dish_id = int(parts[3])
     
-    dish = db.get_dish(dish_id)
+    dish = await db.get_dish(dish_id)
     if not dish:
-        await callback.answer("Блюдо не найдено", show_alert=True)
+        outbox.answer_callback(callback, "Блюдо не найдено", show_alert=True)
         return
     
     eco_packaging = pack_type == "eco"
     
     # Добавляем в корзину
-    cart = get_user_cart(callback.from_user.id)
-    cart.append({
-        "dish_id": dish_id,
-        "dish_name": dish.name,
-        "price": dish.price,
-        "eco_packaging": eco_packaging,
-        "eco_fee": 150 if eco_packaging else 0
-    })
+    await carts.add(callback.from_user.id, dish_id, eco_packaging)
     
     pack_text = "в экоупаковке ♻️" if eco_packaging else "в обычной упаковке"
     
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         f"✅ <b>Блюдо добавлено в корзину!</b>\n\n"
         f"🍽 {dish.name}\n"
         f"💰 {dish.price}₸\n"
@@ -238,15 +235,15 @@ async def add_to_cart(callback: CallbackQuery):
         reply_markup=get_after_add_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer("Добавлено в корзину! 🛒")
+    outbox.answer_callback(callback, "Добавлено в корзину! 🛒")
 
 @router.callback_query(F.data == "view_cart")
 async def view_cart_callback(callback: CallbackQuery):
     await show_cart(callback.from_user.id, callback.message, edit=True)
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 async def show_cart(user_id: int, message: Message, edit: bool = False):
-    cart = get_user_cart(user_id)
+    cart = await get_user_cart(user_id)
     
     if not cart:
         text = "🛒 <b>Ваша корзина пуста</b>\n\nДобавьте блюда из меню ресторанов!"
@@ -268,29 +265,27 @@ async def show_cart(user_id: int, message: Message, edit: bool = False):
         keyboard = get_cart_keyboard()
     
     if edit:
-        try:
-            await message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
-        except Exception:
-            await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+        outbox.edit_text(message, text, fallback=True, reply_markup=keyboard, parse_mode="HTML")
     else:
-        await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+        outbox.answer(message, text, reply_markup=keyboard, parse_mode="HTML")
 
 @router.callback_query(F.data == "clear_cart")
 async def clear_cart(callback: CallbackQuery):
-    clear_user_cart(callback.from_user.id)
-    await callback.message.edit_text(
+    await clear_user_cart(callback.from_user.id)
+    outbox.edit_text(
+        callback.message,
         "🗑 <b>Корзина очищена</b>",
         reply_markup=get_back_button(),
         parse_mode="HTML"
     )
-    await callback.answer("Корзина очищена")
+    outbox.answer_callback(callback, "Корзина очищена")
 
 @router.callback_query(F.data == "checkout")
 async def checkout(callback: CallbackQuery):
-    cart = get_user_cart(callback.from_user.id)
+    cart = await get_user_cart(callback.from_user.id)
     
     if not cart:
-        await callback.answer("Корзина пуста!", show_alert=True)
+        outbox.answer_callback(callback, "Корзина пуста!", show_alert=True)
         return
     
     try:
@@ -308,35 +303,39 @@ async def checkout(callback: CallbackQuery):
             for item in cart
         ]
         
-        order = db.create_order(callback.from_user.id, order_items)
-        total = sum(item["price"] + item["eco_fee"] for item in cart)
-        
-        clear_user_cart(callback.from_user.id)
-        
-        await callback.message.edit_text(
-            "✅ <b>Спасибо! Ваш заказ оформлен 💚</b>\n\n"
-            f"💰 Сумма заказа: {total}₸\n"
-            f"🌿 Ваш бонус за использование экоупаковки: +{bonus_points} EcoPoints",
-            reply_markup=get_back_button(),
-            parse_mode="HTML"
-        )
-        await callback.answer("Заказ оформлен! 🎉")
+        # Повторная доставка того же нажатия (тот же callback.id) не создаст второй заказ
+        order = await db.create_order(callback.from_user.id, order_items, idempotency_key=callback.id)
     except Exception as e:
         logger.error(f"Error creating order: {e}")
-        await callback.answer("Ошибка при оформлении заказа", show_alert=True)
+        outbox.answer_callback(callback, "Ошибка при оформлении заказа", show_alert=True)
+        return
+    
+    # Заказ уже сохранён: ошибки ниже не должны сообщать, что он не оформлен
+    total = sum(item["price"] + item["eco_fee"] for item in cart)
+    await clear_user_cart(callback.from_user.id)
+    
+    outbox.edit_text(
+        callback.message,
+        "✅ <b>Спасибо! Ваш заказ оформлен 💚</b>\n\n"
+        f"💰 Сумма заказа: {total}₸\n"
+        f"🌿 Ваш бонус за использование экоупаковки: +{bonus_points} EcoPoints",
+        reply_markup=get_back_button(),
+        parse_mode="HTML"
+    )
+    outbox.answer_callback(callback, "Заказ оформлен! 🎉")
 
 @router.callback_query(F.data == "my_bonus")
 async def my_bonus_callback(callback: CallbackQuery):
     await show_bonus(callback.from_user.id, callback.message, edit=True)
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 async def show_bonus(user_id: int, message: Message, edit: bool = False):
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         # Создаем нового пользователя если его нет
-        db.get_or_create_user(user_id)
-        user = db.get_user(user_id)
+        await db.get_or_create_user(user_id)
+        user = await db.get_user(user_id)
     
     if user:
         text = (
@@ -349,53 +348,60 @@ async def show_bonus(user_id: int, message: Message, edit: bool = False):
         text = "❌ Ошибка при получении данных пользователя"
     
     if edit:
-        try:
-            await message.edit_text(text, reply_markup=get_back_button(), parse_mode="HTML")
-        except Exception:
-            await message.answer(text, reply_markup=get_back_button(), parse_mode="HTML")
+        outbox.edit_text(message, text, fallback=True, reply_markup=get_back_button(), parse_mode="HTML")
     else:
-        await message.answer(text, reply_markup=get_back_button(), parse_mode="HTML")
+        outbox.answer(message, text, reply_markup=get_back_button(), parse_mode="HTML")
+
+@router.callback_query(F.data == "leaderboard")
+async def show_leaderboard(callback: CallbackQuery):
+    top = await db.get_leaderboard(10)
+    me = await db.get_user_rank(callback.from_user.id)
+    
+    text = "🏆 <b>Рейтинг EcoPoints</b>\n\n"
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    for entry in top:
+        name = entry["username"] or f"user{entry['telegram_id']}"
+        text += f"{medals.get(entry['rank'], str(entry['rank']) + '.')} {name} — {entry['eco_points']} EcoPoints\n"
+    if me:
+        text += f"\n💚 Ваше место: <b>{me['rank']}</b> из {me['total_users']} ({me['eco_points']} EcoPoints)"
+    
+    outbox.edit_text(callback.message, text, reply_markup=get_back_button(), parse_mode="HTML")
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data == "return_containers")
 async def return_containers(callback: CallbackQuery):
-    keyboard = [
-        [InlineKeyboardButton(text="📦 Я хочу вернуть контейнеры", callback_data="confirm_return")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
-    ]
-    
-    try:
-        await callback.message.edit_text(
-            "🔄 <b>Возврат контейнеров</b>\n\n"
-            "Вы можете вернуть эко-контейнеры курьеру и получить бонусы.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard),
-            parse_mode="HTML"
-        )
-    except Exception:
-        pass
-    await callback.answer()
+    outbox.edit_text(
+        callback.message,
+        "🔄 <b>Возврат контейнеров</b>\n\n"
+        "Вы можете вернуть эко-контейнеры курьеру и получить бонусы.",
+        reply_markup=keyboards.return_containers,
+        parse_mode="HTML"
+    )
+    outbox.answer_callback(callback)
 
 @router.callback_query(F.data == "confirm_return")
 async def confirm_return(callback: CallbackQuery):
-    db.add_eco_points(callback.from_user.id, 5, "container_return")
-    user = db.get_user(callback.from_user.id)
+    balance = await accruals.add(callback.from_user.id, 5, "container_return", idempotency_key=callback.id)
     
-    if not user:
-        await callback.answer("Ошибка при получении данных", show_alert=True)
+    if balance is None:
+        outbox.answer_callback(callback, "Ошибка при получении данных", show_alert=True)
         return
     
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         "✅ <b>Отлично!</b>\n\n"
         "Курьер заберёт контейнеры при следующем заказе.\n"
         f"💚 +5 EcoPoints начислены\n\n"
-        f"Ваш баланс: {user['eco_points']} EcoPoints",
+        f"Ваш баланс: {balance} EcoPoints",
         reply_markup=get_back_button(),
         parse_mode="HTML"
     )
-    await callback.answer("Спасибо за заботу о природе! 🌱")
+    outbox.answer_callback(callback, "Спасибо за заботу о природе! 🌱")
 
 @router.callback_query(F.data == "about_service")
 async def about_service(callback: CallbackQuery):
-    await callback.message.edit_text(
+    outbox.edit_text(
+        callback.message,
         "ℹ️ <b>О сервисе EcoEats</b>\n\n"
         "🌱 EcoEats — это экологичная доставка еды.\n\n"
         "♻️ Мы используем экоупаковку (+150–200₸) и начисляем бонусы за возврат контейнеров.\n\n"
@@ -408,7 +414,7 @@ async def about_service(callback: CallbackQuery):
         reply_markup=get_back_button(),
         parse_mode="HTML"
     )
-    await callback.answer()
+    outbox.answer_callback(callback)
 
 # === ОБРАБОТЧИКИ ДЛЯ НЕПОДДЕРЖИВАЕМЫХ ОБНОВЛЕНИЙ ===
 @router.message()
@@ -419,19 +425,56 @@ async def echo(message: Message):
 @router.callback_query()
 async def handle_unknown_callback(callback: CallbackQuery):
     """Обработчик для неизвестных callback queries"""
-    await callback.answer("Неизвестная команда", show_alert=False)
+    outbox.answer_callback(callback, "Неизвестная команда", show_alert=False)
 
 # === ЗАПУСК БОТА ===
-async def main():
+async def on_startup():
+    carts.start()
+    metrics_reporter.start()
+    outbox.start()
+    broadcasts.start()
+
+async def on_shutdown():
+    await metrics_reporter.close()
+    await broadcasts.close()
+    await outbox.close()
+    await carts.close()
+    await accruals.close()
+    await storage.close()
+    db.close()
+
+def setup_dispatcher() -> Dispatcher:
+    """Подключить роутер и хуки запуска/остановки к диспетчеру"""
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+async def main():
+    setup_dispatcher()
+    # BOT_MODE=webhook — приём апдейтов через HTTP (см. webhook.py)
+    mode = os.getenv("BOT_MODE", "polling")
     logger.info("🤖 Бот EcoEats запущен!")
     logger.info("🌱 Версия: MVP v1.0 с БД")
     logger.info("📊 База данных: ecoeats.db")
-    logger.info("🚀 Режим: 24/7 (AWS Ready)")
+    logger.info(f"🚀 Режим: {mode} (AWS Ready)")
     
     try:
-        await dp.start_polling(bot, handle_signals=False)
+        if mode == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            metrics_port = os.getenv("BOT_METRICS_PORT")
+            metrics_server = None
+            if metrics_port:
+                metrics_server = await start_metrics_server(os.getenv("BOT_METRICS_HOST", "0.0.0.0"), int(metrics_port))
+            await bot.delete_webhook(drop_pending_updates=True)
+            try:
+                # SIGTERM/SIGINT останавливают polling штатно: хуки остановки
+                # дописывают очереди (корзины, начисления, исходящие) до выхода
+                await dp.start_polling(bot, handle_signals=True)
+            finally:
+                if metrics_server:
+                    await metrics_server.cleanup()
     except Exception as e:
         logger.error(f"Ошибка при работе бота: {e}")
         raise
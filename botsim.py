@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Симулятор нагрузки на бота без Telegram
+
+Синтетические пользователи проходят сценарий /start → рестораны → блюда →
+добавление в корзину → корзина → оформление заказа → возврат контейнеров →
+бонусы. Апдейты (Message и CallbackQuery) подаются прямо в dp.feed_update,
+а запросы к Bot API отвечает заглушка сессии (с задержкой --api-latency),
+поэтому работает весь стек обработчиков: фильтры, middleware, хранилища,
+БД. Печатает апдейтов в секунду и задержки по обработчикам (JSON).
+
+Лимиты очереди исходящих (outbox.py) по умолчанию сняты, чтобы мерить
+обработчики; --rate-limits оставляет настройки OUTBOX_*, а --flood-rate
+заставляет заглушку отвечать 429 на эту долю запросов.
+
+Запуск:
+    python manage.py botsim [--users 500] [--concurrency 50] [--api-latency 0]
+                            [--rate-limits] [--flood-rate 0.05]
+                            [--seed 42] [--db-url URL] [--out result.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Chat, Message, TelegramObject, Update
+
+from profiling import percentile
+
+SIM_USER_BASE = 20_000_000
+
+
+class SimulatedSession(BaseSession):
+    """Сессия Bot API, отвечающая без сети"""
+
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, seed: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.requests = 0
+        self.flood_errors = 0
+        self._message_id = 0
+        self._rng = random.Random(seed)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self._rng.random() < self.flood_rate:
+            self.flood_errors += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests: retry after 1", retry_after=1)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            self._message_id += 1
+            return Message(
+                message_id=getattr(method, "message_id", None) or self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def close(self):
+        pass
+
+
+def _counter_total(counter) -> int:
+    return int(sum(child.value for _, child in counter.items()))
+
+
+class HandlerTimer(BaseMiddleware):
+    """Точные задержки по обработчикам (в дополнение к гистограммам bot_metrics)"""
+
+    def __init__(self, handler_name: Callable[[Dict[str, Any]], str]):
+        self.handler_name = handler_name
+        self.latencies: Dict[str, List[float]] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latencies.setdefault(self.handler_name(data), []).append(time.perf_counter() - started)
+
+
+class UpdateFactory:
+    """Апдейты от имени синтетических пользователей"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Sim", "username": f"sim{user_id}"}
+
+    def _message(self, user_id: int, text: str, message_id: int = None) -> dict:
+        return {
+            "message_id": message_id or self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def command(self, user_id: int, text: str) -> Update:
+        update_id = self._next_id()
+        message = self._message(user_id, text)
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.model_validate({"update_id": update_id, "message": message}, context={"bot": self.bot})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = self._next_id()
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": f"sim-{update_id}",
+                "chat_instance": str(user_id),
+                "from": self._user(user_id),
+                # Кнопки одного меню: бот правит одно и то же сообщение
+                "message": self._message(user_id, "…", message_id=1),
+                "data": data,
+            },
+        }, context={"bot": self.bot})
+
+
+def user_journey(factory: UpdateFactory, rng: random.Random, user_id: int, menu: Dict[int, List[int]]):
+    """Апдейты одного пользователя в порядке сценария"""
+    yield factory.command(user_id, "/start")
+    yield factory.callback(user_id, "menu_restaurants")
+    for _ in range(rng.randint(1, 3)):
+        restaurant_id = rng.choice([rid for rid, dishes in menu.items() if dishes])
+        dish_id = rng.choice(menu[restaurant_id])
+        yield factory.callback(user_id, f"rest|{restaurant_id}")
+        yield factory.callback(user_id, f"dish|{restaurant_id}|{dish_id}")
+        packaging = "eco" if rng.random() < 0.6 else "regular"
+        yield factory.callback(user_id, f"pack|{packaging}|{restaurant_id}|{dish_id}")
+    yield factory.callback(user_id, "view_cart")
+    yield factory.callback(user_id, "checkout")
+    if rng.random() < 0.5:
+        yield factory.callback(user_id, "return_containers")
+        yield factory.callback(user_id, "confirm_return")
+    yield factory.callback(user_id, "my_bonus")
+
+
+async def run_simulation(args) -> dict:
+    import bot_with_db
+    from bot_metrics import BOT_HANDLER_API_SECONDS, BOT_HANDLER_DB_SECONDS, handler_name
+    from outbox import OUTBOX_COALESCED, OUTBOX_FAILED, OUTBOX_RETRY_AFTER, OUTBOX_SENT
+
+    # Лог «Update is handled» на каждый апдейт заметно тормозит симуляцию
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    bot = bot_with_db.bot
+    session = SimulatedSession(args.api_latency / 1000, args.flood_rate, args.seed)
+    # Middleware сессии (замер времени Bot API) переносим в заглушку
+    session.middleware = bot.session.middleware
+    bot.session = session
+
+    dp = bot_with_db.setup_dispatcher()
+    timer = HandlerTimer(handler_name)
+    bot_with_db.router.message.middleware(timer)
+    bot_with_db.router.callback_query.middleware(timer)
+
+    snapshot = await bot_with_db.db.get_menu()
+    menu = {restaurant.id: [dish.id for dish in snapshot.dishes_by_restaurant.get(restaurant.id, ())]
+            for restaurant in snapshot.restaurants}
+    factory = UpdateFactory(bot)
+    rng = random.Random(args.seed)
+    journeys = [
+        list(user_journey(factory, random.Random(rng.random()), SIM_USER_BASE + i, menu))
+        for i in range(args.users)
+    ]
+
+    errors: Dict[str, int] = {}
+    pending = iter(journeys)
+
+    async def worker():
+        for journey in pending:
+            for update in journey:
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    kind = type(e).__name__
+                    errors[kind] = errors.get(kind, 0) + 1
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+    finally:
+        # Остановка дожидается отправки очереди исходящих
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        drained = time.perf_counter() - started
+
+    db_sums = {values[0]: child.sum for values, child in BOT_HANDLER_DB_SECONDS.items()}
+    api_sums = {values[0]: child.sum for values, child in BOT_HANDLER_API_SECONDS.items()}
+    updates = sum(len(journey) for journey in journeys)
+    handlers = {}
+    for name, latencies in sorted(timer.latencies.items(), key=lambda item: -sum(item[1])):
+        handlers[name] = {
+            "calls": len(latencies),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(latencies) * 1000, 2),
+            "mean_db_ms": round(db_sums.get(name, 0.0) / len(latencies) * 1000, 2),
+            "mean_api_ms": round(api_sums.get(name, 0.0) / len(latencies) * 1000, 2),
+        }
+    return {
+        "scenario": "botsim",
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency,
+        "updates": updates,
+        "duration_s": round(elapsed, 2),
+        "updates_per_sec": round(updates / elapsed, 1),
+        "api_requests": session.requests,
+        "outbox": {
+            "drain_s": round(drained, 2),
+            "sent": _counter_total(OUTBOX_SENT),
+            "failed": _counter_total(OUTBOX_FAILED),
+            "coalesced": _counter_total(OUTBOX_COALESCED),
+            "retry_after": _counter_total(OUTBOX_RETRY_AFTER),
+        },
+        "errors": errors,
+        "handlers": handlers,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Симулятор нагрузки на бота (без Telegram)")
+    parser.add_argument("--users", type=int, default=500, help="Синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=50, help="Пользователей, действующих одновременно")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Задержка ответа Bot API, мс")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Оставить лимиты очереди исходящих (OUTBOX_*)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Доля запросов, получающих ответ 429")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db-url", help="URL БД; по умолчанию временный SQLite-файл")
+    parser.add_argument("--out", help="Записать JSON в файл вместо stdout")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot_with_db читает окружение при импорте
+        os.environ["DATABASE_URL"] = args.db_url or f"sqlite:///{os.path.join(tmp, 'botsim.db')}"
+        os.environ.setdefault("DB_ENGINE_PROFILE", "concurrent")
+        os.environ.setdefault("BOT_TOKEN", "123456:SIMULATOR-TOKEN-NOT-USED-FOR-NETWORK")
+        os.environ.setdefault("BOT_METRICS_LOG_INTERVAL", "0")
+        if not args.rate_limits:
+            os.environ["OUTBOX_GLOBAL_RATE"] = "0"
+            os.environ["OUTBOX_CHAT_RATE"] = "0"
+        report = asyncio.run(run_simulation(args))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ Результат записан в {args.out}")
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Рассылка сообщения всем пользователям бота
+
+Рассылку отправляет сам бот (bot_with_db.py): лимит Telegram — на бота,
+поэтому сообщения рассылки идут через ту же очередь исходящих (outbox.py),
+что и ответы пользователям, как массовые (bulk) — им достаётся только та
+часть лимита, которую не заняли ответы. manage.py лишь создаёт рассылку,
+а бот раз в BROADCAST_POLL_INTERVAL секунд забирает ожидающие.
+
+Получатели фиксируются при создании (users.id не больше максимального на
+тот момент) и читаются пачками по BROADCAST_CHUNK_SIZE с keyset-пагинацией
+по users.id. Следующая пачка читается и ставится в очередь, пока
+отправляется текущая.
+
+После каждой отправленной пачки прогресс (последний users.id, доставлено,
+ошибок) сохраняется в таблицу broadcasts, поэтому после сбоя рассылка
+продолжается с места остановки: повторно может уйти не больше
+BROADCAST_WINDOW пачек, ещё не подтверждённых на момент сбоя. При штатной
+остановке бот возвращает рассылку в ожидание; если процесс упал, её
+забирает любая реплика, когда прогресс не сохранялся BROADCAST_LEASE секунд.
+
+Запуск:
+    python manage.py broadcast send "Текст" [--parse-mode HTML]
+    python manage.py broadcast status [ID]
+    python manage.py broadcast cancel ID
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from database import AsyncDatabaseService
+from outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED = ["pending", "running"]
+
+
+class BroadcastRunner:
+    """Отправка рассылок через очередь исходящих бота с сохранением прогресса"""
+
+    def __init__(self, db: AsyncDatabaseService, outbox: Outbox, chunk_size: int = None, window: int = None,
+                 poll_interval: float = None, lease: float = None):
+        if chunk_size is None:
+            chunk_size = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+        if window is None:
+            window = int(os.getenv("BROADCAST_WINDOW", "2"))
+        if poll_interval is None:
+            poll_interval = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+        if lease is None:
+            lease = float(os.getenv("BROADCAST_LEASE", "120"))
+        self.db = db
+        self.outbox = outbox
+        self.chunk_size = chunk_size
+        self.window = max(window, 1)
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._task: Optional[asyncio.Task] = None
+
+    # === ФОНОВАЯ ОТПРАВКА ===
+    def start(self):
+        """Запустить фоновую проверку новых и прерванных рассылок"""
+        if self._task is None and self.poll_interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        """Остановить отправку; текущая рассылка возвращается в ожидание"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            try:
+                for broadcast in reversed(await self.db.get_broadcasts(UNFINISHED, limit=100)):
+                    await self.run(broadcast["id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка рассылки: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self, broadcast_id: int) -> Optional[dict]:
+        """Отправить (или продолжить) рассылку; возвращает итоговое состояние
+        Если рассылку уже отправляет другой процесс, возвращает её как есть.
+        """
+        broadcast = await self.db.claim_broadcast(broadcast_id, self.lease)
+        if broadcast is None:
+            return await self.db.get_broadcast(broadcast_id)
+        logger.info(f"Рассылка {broadcast_id}: отправка {broadcast['recipients']} получателям")
+        try:
+            return await self._send(broadcast)
+        except asyncio.CancelledError:
+            # Остановка бота: отпускаем рассылку, продолжит следующий запуск или другая реплика
+            await self.db.save_broadcast_progress(broadcast_id, status="pending")
+            raise
+
+    async def _send(self, broadcast: dict) -> dict:
+        broadcast_id = broadcast["id"]
+        self.delivered = broadcast["delivered"]
+        self.failed = broadcast["failed"]
+        text, parse_mode = broadcast["text"], broadcast["parse_mode"]
+        started = time.perf_counter()
+        sent_before = self.delivered + self.failed
+
+        # Отправляемые пачки: (последний users.id пачки, futures сообщений)
+        in_flight: Deque[Tuple[int, List[asyncio.Future]]] = deque()
+        max_user_id = broadcast["max_user_id"]
+        next_chunk = asyncio.create_task(
+            self.db.get_broadcast_recipients(broadcast["last_user_id"], self.chunk_size, max_user_id))
+        try:
+            while True:
+                recipients = await next_chunk
+                if not recipients:
+                    break
+                next_chunk = asyncio.create_task(
+                    self.db.get_broadcast_recipients(recipients[-1][0], self.chunk_size, max_user_id))
+                in_flight.append((recipients[-1][0], [
+                    self.outbox.send_message(telegram_id, text, bulk=True, parse_mode=parse_mode)
+                    for _, telegram_id in recipients
+                ]))
+                while len(in_flight) >= self.window:
+                    broadcast = await self._checkpoint(broadcast_id, *in_flight.popleft())
+                    if broadcast["status"] == "cancelled":
+                        logger.info(f"Рассылка {broadcast_id} отменена")
+                        return broadcast
+                    sent = self.delivered + self.failed
+                    logger.info(f"Рассылка {broadcast_id}: {sent}/{broadcast['recipients']}, "
+                                f"{(sent - sent_before) / (time.perf_counter() - started):.1f} сообщ./с")
+            while in_flight:
+                broadcast = await self._checkpoint(broadcast_id, *in_flight.popleft())
+        finally:
+            next_chunk.cancel()
+            for _, futures in in_flight:
+                for future in futures:
+                    future.cancel()
+
+        if broadcast["status"] == "cancelled":
+            return broadcast
+        return await self.db.save_broadcast_progress(broadcast_id, status="completed")
+
+    async def _checkpoint(self, broadcast_id: int, last_user_id: int, futures: List[asyncio.Future]) -> dict:
+        """Дождаться отправки пачки и сохранить прогресс"""
+        while True:
+            _, pending = await asyncio.wait(futures, timeout=self.lease / 3)
+            if not pending:
+                break
+            # Ответы пользователям заняли лимит: продлеваем аренду, чтобы
+            # рассылку не забрала другая реплика
+            await self.db.save_broadcast_progress(broadcast_id)
+        failed = sum(1 for future in futures if future.cancelled() or future.exception() is not None)
+        self.delivered += len(futures) - failed
+        self.failed += failed
+        return await self.db.save_broadcast_progress(broadcast_id, last_user_id, self.delivered, self.failed)
+
+
+def format_broadcast(broadcast: dict) -> str:
+    return (f"#{broadcast['id']} [{broadcast['status']}] доставлено {broadcast['delivered']}, "
+            f"ошибок {broadcast['failed']} из {broadcast['recipients']}: {broadcast['text'][:40]!r}")
+
+
+async def run_cli(args) -> List[dict]:
+    from database import DatabaseService
+
+    db = AsyncDatabaseService(DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db")))
+    try:
+        if args.action == "send":
+            return [await db.create_broadcast(args.text, args.parse_mode or None)]
+        if args.action == "status":
+            if args.id:
+                broadcast = await db.get_broadcast(args.id)
+                return [broadcast] if broadcast else []
+            return await db.get_broadcasts()
+        broadcast = await db.save_broadcast_progress(args.id, status="cancelled")
+        return [broadcast] if broadcast else []
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="manage.py broadcast", description="Рассылка всем пользователям")
+    actions = parser.add_subparsers(dest="action", required=True)
+    send = actions.add_parser("send", help="Создать рассылку (отправит бот)")
+    send.add_argument("text")
+    send.add_argument("--parse-mode", default="HTML", help="HTML, Markdown или пусто")
+    status = actions.add_parser("status", help="Состояние рассылок")
+    status.add_argument("id", type=int, nargs="?")
+    cancel = actions.add_parser("cancel", help="Остановить рассылку")
+    cancel.add_argument("id", type=int)
+    args = parser.parse_args(argv)
+
+    broadcasts = asyncio.run(run_cli(args))
+    if not broadcasts:
+        print("❌ Рассылки не найдены")
+    for broadcast in broadcasts:
+        print(f"{'✅' if broadcast['status'] == 'completed' else '📨'} {format_broadcast(broadcast)}")
+    if args.action == "send":
+        print("ℹ️  Рассылку отправит запущенный бот (python manage.py bot)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,176 @@
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import create_engine
-from models import Base, User, Restaurant, Dish, Order, OrderItem, EcoPoint
-from datetime import datetime
-from typing import List, Optional
+import asyncio
+import atexit
+import base64
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from sqlalchemy.orm import joinedload, sessionmaker, Session
+from sqlalchemy import Text, bindparam, case, delete, func, insert, inspect, or_, text, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from db_engine import EngineProfile, create_db_engine, sqlite_url
+from leaderboard import Leaderboard
+from metrics import record_db_time
+from profiling import profile_service
+from models import Base, User, Restaurant, Dish, Order, OrderItem, EcoPoint, KVEntry, UserStats, IdempotencyKey, Broadcast
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+
+# === MENU CACHE ===
+@dataclass(frozen=True)
+class MenuRestaurant:
+    id: int
+    name: str
+    emoji: str
+    description: Optional[str]
+
+
+@dataclass(frozen=True)
+class MenuDish:
+    id: int
+    restaurant_id: int
+    name: str
+    price: float
+    description: Optional[str]
+
+
+@dataclass(frozen=True)
+class MenuSnapshot:
+    """Неизменяемый снимок меню: рестораны и блюда с индексами по ID"""
+    version: int
+    restaurants: Tuple[MenuRestaurant, ...]
+    dishes: Tuple[MenuDish, ...]
+    restaurants_by_id: Dict[int, MenuRestaurant]
+    dishes_by_id: Dict[int, MenuDish]
+    dishes_by_restaurant: Dict[int, Tuple[MenuDish, ...]]
+
+    @classmethod
+    def build(cls, version: int, restaurants, dishes) -> "MenuSnapshot":
+        restaurants = tuple(restaurants)
+        dishes = tuple(dishes)
+        by_restaurant = {rest.id: [] for rest in restaurants}
+        for dish in dishes:
+            by_restaurant.setdefault(dish.restaurant_id, []).append(dish)
+        return cls(
+            version=version,
+            restaurants=restaurants,
+            dishes=dishes,
+            restaurants_by_id={rest.id: rest for rest in restaurants},
+            dishes_by_id={dish.id: dish for dish in dishes},
+            dishes_by_restaurant={rid: tuple(items) for rid, items in by_restaurant.items()},
+        )
+
+
+class MenuCache:
+    """Кэш меню в памяти процесса.
+
+    Меню меняется редко, поэтому навигация по нему читает снимок без запросов
+    к БД. Снимок перечитывается по истечении TTL (изменения из другого
+    процесса, например API) или сразу после invalidate() при записи меню.
+    Версия снимка меняется только если содержимое меню действительно изменилось.
+    """
+
+    def __init__(self, loader, ttl: float = None):
+        self._loader = loader
+        if ttl is None:
+            ttl = float(os.getenv("MENU_CACHE_TTL", "300"))
+        self.ttl = ttl
+        self._snapshot: Optional[MenuSnapshot] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        return self._snapshot is not None and time.monotonic() < self._expires_at
+
+    def get(self) -> MenuSnapshot:
+        """Получить актуальный снимок меню"""
+        if self.is_fresh():
+            return self._snapshot
+        with self._lock:
+            if not self.is_fresh():
+                self._reload()
+            return self._snapshot
+
+    def invalidate(self):
+        """Сбросить снимок: следующее чтение загрузит меню из БД"""
+        self._expires_at = 0.0
+
+    def _reload(self):
+        restaurants, dishes = self._loader()
+        current = self._snapshot
+        if current is None or current.restaurants != tuple(restaurants) or current.dishes != tuple(dishes):
+            version = current.version + 1 if current else 1
+            self._snapshot = MenuSnapshot.build(version, restaurants, dishes)
+        self._expires_at = time.monotonic() + self.ttl
+
+
+def encode_order_cursor(order: Order) -> str:
+    """Курсор страницы истории заказов: (created_at, id) последнего заказа"""
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_order_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Разобрать курсор; ValueError, если он повреждён"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(order_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+# (таблица, столбец, DDL для добавления) — столбцы, появившиеся после создания таблиц
+ADDED_COLUMNS = [
+    ("kv_store", "expires_at", [
+        "ALTER TABLE kv_store ADD COLUMN expires_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS ix_kv_store_expires_at ON kv_store (expires_at)",
+    ]),
+    ("broadcasts", "max_user_id", ["ALTER TABLE broadcasts ADD COLUMN max_user_id INTEGER"]),
+]
+
 
 class DatabaseService:
-    def __init__(self, db_path: str = "ecoeats.db"):
-        self.engine = create_engine(f"sqlite:///{db_path}", echo=False)
+    def __init__(self, db_path: str = "ecoeats.db", profile: EngineProfile = None, db_url: str = None):
+        """db_url: полный URL БД (sqlite:///..., postgresql://...); по умолчанию SQLite-файл db_path"""
+        self.engine = create_db_engine(db_url or sqlite_url(db_path), profile)
         Base.metadata.create_all(self.engine)
-        self.SessionLocal = sessionmaker(bind=self.engine)
+        self._add_missing_columns()
+        # Объекты, возвращаемые после commit (например, Order), остаются читаемыми
+        self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.menu = MenuCache(self._load_menu)
+        self.leaderboard = Leaderboard(self._load_points_histogram)
+        # Сколько секунд хранится результат по ключу идемпотентности
+        self.idempotency_ttl = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
         self._init_default_data()
+        self._backfill_user_stats()
+        # DB_PROFILE=1: статистика SQL-запросов по методам (см. profiling.py),
+        # отчёт пишется при выходе в DB_PROFILE_REPORT или в stdout
+        self.profiler = None
+        if os.getenv("DB_PROFILE", "0").lower() in ("1", "true", "yes"):
+            self.profiler = profile_service(self)
+            atexit.register(self._dump_profile)
+    
+    def _add_missing_columns(self):
+        """Добавить столбцы, появившиеся после создания таблиц (create_all их не добавляет)"""
+        inspector = inspect(self.engine)
+        for table, column, statements in ADDED_COLUMNS:
+            if column in {c["name"] for c in inspector.get_columns(table)}:
+                continue
+            with self.engine.begin() as conn:
+                for statement in statements:
+                    conn.execute(text(statement))
+    
+    def _dump_profile(self):
+        path = os.getenv("DB_PROFILE_REPORT")
+        if path:
+            self.profiler.dump(path)
+        else:
+            print(self.profiler.format_report())
     
     def get_session(self) -> Session:
         """Получить новую сессию"""
@@ -34,23 +195,25 @@ class DatabaseService:
         session.commit()
         
         # Добавляем блюда
+        rest_a, rest_b, rest_c = restaurants
         dishes = [
             # Restaurant A
-            Dish(restaurant_id=1, name="Пицца Маргарита", price=2500, description="Классическая пицца"),
-            Dish(restaurant_id=1, name="Паста Карбонара", price=3200, description="Паста с беконом и сливками"),
-            Dish(restaurant_id=1, name="Салат Цезарь", price=1800, description="Свежий салат"),
+            Dish(restaurant_id=rest_a.id, name="Пицца Маргарита", price=2500, description="Классическая пицца"),
+            Dish(restaurant_id=rest_a.id, name="Паста Карбонара", price=3200, description="Паста с беконом и сливками"),
+            Dish(restaurant_id=rest_a.id, name="Салат Цезарь", price=1800, description="Свежий салат"),
             # Restaurant B
-            Dish(restaurant_id=2, name="Рамен", price=2800, description="Японская лапша"),
-            Dish(restaurant_id=2, name="Суши сет", price=4500, description="Набор суши"),
-            Dish(restaurant_id=2, name="Том Ям", price=2200, description="Острый тайский суп"),
+            Dish(restaurant_id=rest_b.id, name="Рамен", price=2800, description="Японская лапша"),
+            Dish(restaurant_id=rest_b.id, name="Суши сет", price=4500, description="Набор суши"),
+            Dish(restaurant_id=rest_b.id, name="Том Ям", price=2200, description="Острый тайский суп"),
             # Restaurant C
-            Dish(restaurant_id=3, name="Бургер Классик", price=2000, description="Классический бургер"),
-            Dish(restaurant_id=3, name="Картофель фри", price=800, description="Хрустящий картофель"),
-            Dish(restaurant_id=3, name="Молочный коктейль", price=1200, description="Сладкий коктейль"),
+            Dish(restaurant_id=rest_c.id, name="Бургер Классик", price=2000, description="Классический бургер"),
+            Dish(restaurant_id=rest_c.id, name="Картофель фри", price=800, description="Хрустящий картофель"),
+            Dish(restaurant_id=rest_c.id, name="Молочный коктейль", price=1200, description="Сладкий коктейль"),
         ]
         session.add_all(dishes)
         session.commit()
         session.close()
+        self.invalidate_menu()
     
     # === USER METHODS ===
     def get_or_create_user(self, telegram_id: int, username: str = None) -> dict:
@@ -61,7 +224,13 @@ class DatabaseService:
         if not user:
             user = User(telegram_id=telegram_id, username=username)
             session.add(user)
-            session.commit()
+            try:
+                session.commit()
+                self.leaderboard.record_user(user.eco_points or 0)
+            except IntegrityError:
+                # Пользователя параллельно создал другой процесс/реплика
+                session.rollback()
+                user = session.query(User).filter(User.telegram_id == telegram_id).one()
         
         user_data = {
             "id": user.id,
@@ -95,66 +264,109 @@ class DatabaseService:
         session.close()
         return user_data
     
-    # === RESTAURANT METHODS ===
-    def get_restaurants(self) -> List[Restaurant]:
-        """Получить все рестораны"""
+    # === MENU METHODS ===
+    def _load_menu(self) -> Tuple[List[MenuRestaurant], List[MenuDish]]:
+        """Загрузить меню из БД (используется MenuCache)"""
         session = self.get_session()
-        restaurants = session.query(Restaurant).all()
+        restaurants = [
+            MenuRestaurant(id=r.id, name=r.name, emoji=r.emoji, description=r.description)
+            for r in session.query(Restaurant).order_by(Restaurant.id).all()
+        ]
+        dishes = [
+            MenuDish(id=d.id, restaurant_id=d.restaurant_id, name=d.name,
+                     price=d.price, description=d.description)
+            for d in session.query(Dish).order_by(Dish.id).all()
+        ]
         session.close()
-        return restaurants
-    
-    def get_restaurant(self, restaurant_id: int) -> Optional[Restaurant]:
-        """Получить ресторан по ID"""
+        return restaurants, dishes
+
+    def get_menu(self) -> MenuSnapshot:
+        """Получить текущий снимок меню"""
+        return self.menu.get()
+
+    def invalidate_menu(self):
+        """Сбросить кэш меню после изменения ресторанов или блюд"""
+        self.menu.invalidate()
+
+    def add_restaurant(self, name: str, emoji: str, description: str = None) -> MenuRestaurant:
+        """Добавить ресторан"""
         session = self.get_session()
-        restaurant = session.query(Restaurant).filter(Restaurant.id == restaurant_id).first()
+        restaurant = Restaurant(name=name, emoji=emoji, description=description)
+        session.add(restaurant)
+        session.commit()
+        result = MenuRestaurant(id=restaurant.id, name=restaurant.name,
+                                emoji=restaurant.emoji, description=restaurant.description)
         session.close()
-        return restaurant
-    
-    def get_restaurant_by_name(self, name: str) -> Optional[Restaurant]:
-        """Получить ресторан по названию"""
+        self.invalidate_menu()
+        return result
+
+    def add_dish(self, restaurant_id: int, name: str, price: float, description: str = None) -> MenuDish:
+        """Добавить блюдо в меню ресторана"""
         session = self.get_session()
-        restaurant = session.query(Restaurant).filter(Restaurant.name == name).first()
+        dish = Dish(restaurant_id=restaurant_id, name=name, price=price, description=description)
+        session.add(dish)
+        session.commit()
+        result = MenuDish(id=dish.id, restaurant_id=dish.restaurant_id, name=dish.name,
+                          price=dish.price, description=dish.description)
         session.close()
-        return restaurant
+        self.invalidate_menu()
+        return result
+
+    # === RESTAURANT METHODS ===
+    def get_restaurants(self) -> List[MenuRestaurant]:
+        """Получить все рестораны"""
+        return list(self.menu.get().restaurants)
+    
+    def get_restaurant(self, restaurant_id: int) -> Optional[MenuRestaurant]:
+        """Получить ресторан по ID"""
+        return self.menu.get().restaurants_by_id.get(restaurant_id)
+    
+    def get_restaurant_by_name(self, name: str) -> Optional[MenuRestaurant]:
+        """Получить ресторан по названию"""
+        for restaurant in self.menu.get().restaurants:
+            if restaurant.name == name:
+                return restaurant
+        return None
     
     # === DISH METHODS ===
-    def get_dishes(self, restaurant_id: int) -> List[Dish]:
+    def get_dishes(self, restaurant_id: int) -> List[MenuDish]:
         """Получить блюда ресторана"""
-        session = self.get_session()
-        dishes = session.query(Dish).filter(Dish.restaurant_id == restaurant_id).all()
-        session.close()
-        return dishes
+        return list(self.menu.get().dishes_by_restaurant.get(restaurant_id, ()))
     
-    def get_dish(self, dish_id: int) -> Optional[Dish]:
+    def get_dish(self, dish_id: int) -> Optional[MenuDish]:
         """Получить блюдо по ID"""
-        session = self.get_session()
-        dish = session.query(Dish).filter(Dish.id == dish_id).first()
-        session.close()
-        return dish
+        return self.menu.get().dishes_by_id.get(dish_id)
     
     # === CART/ORDER METHODS ===
-    def create_order(self, telegram_id: int, items: List[dict]) -> Order:
-        """Создать заказ
-        items: список {"dish_id": int, "quantity": int, "eco_packaging": bool}
+    def _load_dishes(self, session: Session, carts: List[List[dict]]) -> Dict[int, Dish]:
+        """Блюда всех корзин одним запросом IN"""
+        dish_ids = {item.get("dish_id") for items in carts for item in items}
+        dish_ids.discard(None)
+        if not dish_ids:
+            return {}
+        return {dish.id: dish for dish in session.query(Dish).filter(Dish.id.in_(dish_ids)).all()}
+    
+    def _price_items(self, items: List[dict], dishes: Dict[int, Dish], strict: bool = False):
+        """Посчитать позиции заказа
+        Возвращает (строки order_items без order_id, сумма, экосбор, позиций в экоупаковке).
+        strict: ValueError на неизвестное блюдо или неверное количество вместо пропуска
         """
-        session = self.get_session()
-        
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
-            session.close()
-            raise ValueError("User not found")
-        
         total_amount = 0
         eco_fee_total = 0
-        order_items = []
+        item_rows = []
         eco_count = 0
         
         for item in items:
-            dish = session.query(Dish).filter(Dish.id == item["dish_id"]).first()
+            dish = dishes.get(item.get("dish_id"))
+            quantity = item.get("quantity", 1)
+            if strict:
+                if not dish:
+                    raise ValueError(f"Dish not found: {item.get('dish_id')}")
+                if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+                    raise ValueError(f"Invalid quantity: {quantity}")
             if not dish:
                 continue
             
-            quantity = item.get("quantity", 1)
             eco_packaging = item.get("eco_packaging", False)
             eco_fee = 150 if eco_packaging else 0
             
@@ -162,33 +374,63 @@ class DatabaseService:
             total_amount += item_price
             eco_fee_total += eco_fee * quantity
             
-            order_item = OrderItem(
-                dish_id=dish.id,
-                quantity=quantity,
-                price=dish.price,
-                eco_packaging=eco_packaging,
-                eco_fee=eco_fee
-            )
-            order_items.append(order_item)
+            item_rows.append({
+                "dish_id": dish.id,
+                "quantity": quantity,
+                "price": dish.price,
+                "eco_packaging": eco_packaging,
+                "eco_fee": eco_fee
+            })
             
             if eco_packaging:
                 eco_count += quantity
         
+        return item_rows, total_amount, eco_fee_total, eco_count
+    
+    def create_order(self, telegram_id: int, items: List[dict], idempotency_key: str = None) -> Order:
+        """Создать заказ
+        items: список {"dish_id": int, "quantity": int, "eco_packaging": bool}
+        idempotency_key: повтор с тем же ключом не создаёт заказ заново, а
+            возвращает исходный (несохраняемый объект Order без позиций)
+
+        Число запросов не зависит от размера корзины: блюда читаются одним
+        запросом IN, позиции заказа вставляются одним пакетным INSERT.
+        """
+        key = self._idempotency_key("order", telegram_id, idempotency_key)
+        session = self.get_session()
+        
+        if key:
+            stored = self._idempotency_lookup(session, [key]).get(key)
+            if stored:
+                session.close()
+                return self._order_from_result(stored)
+        
+        user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        if not user:
+            session.close()
+            raise ValueError("User not found")
+        
+        dishes = self._load_dishes(session, [items])
+        item_rows, total_amount, eco_fee_total, eco_count = self._price_items(items, dishes)
+        
         order = Order(
             user_id=user.id,
             total_amount=total_amount,
             eco_fee_total=eco_fee_total,
             status="completed"
         )
-        order.items = order_items
         
         session.add(order)
         session.flush()
         
+        if item_rows:
+            for row in item_rows:
+                row["order_id"] = order.id
+            session.execute(insert(OrderItem), item_rows)
+        
         # Добавляем eco points
         bonus_points = eco_count * 10
-        user.eco_points += bonus_points
-        user.orders_count += 1
+        new_points = self._credit_users(session, {user.id: bonus_points}, {user.id: 1})[user.id]
         
         eco_point = EcoPoint(
             user_id=user.id,
@@ -197,45 +439,921 @@ class DatabaseService:
         )
         session.add(eco_point)
         
-        session.commit()
+        self._apply_order_to_stats(session, user.id, order, eco_count)
+        
+        if key:
+            self._idempotency_store(session, key, "order", {
+                "order_id": order.id,
+                "user_id": order.user_id,
+                "total_amount": order.total_amount,
+                "eco_fee_total": order.eco_fee_total,
+                "status": order.status,
+                "created_at": order.created_at.isoformat(),
+            })
+        
+        try:
+            session.commit()
+        except IntegrityError:
+            # Параллельный запрос с тем же ключом успел раньше: его заказ и возвращаем
+            session.rollback()
+            stored = self._idempotency_lookup(session, [key]).get(key) if key else None
+            session.close()
+            if stored:
+                return self._order_from_result(stored)
+            raise
+        self.leaderboard.record_change(new_points - bonus_points, new_points)
         session.close()
         
         return order
     
-    def add_eco_points(self, telegram_id: int, amount: int, reason: str):
-        """Добавить eco points"""
+    @staticmethod
+    def _credit_users(session: Session, points: Dict[int, int], orders: Dict[int, int] = None) -> Dict[int, int]:
+        """Прибавить пользователям EcoPoints (и заказы) одним UPDATE ... RETURNING
+        Сумму считает БД под блокировкой строки, поэтому параллельные транзакции
+        не теряют начислений (SELECT FOR UPDATE в SQLite ничего не блокирует).
+        Возвращает {users.id: баланс после начисления}.
+        """
+        values = {"eco_points": User.eco_points + case(points, value=User.id, else_=0)}
+        if orders:
+            values["orders_count"] = User.orders_count + case(orders, value=User.id, else_=0)
+        rows = session.execute(
+            update(User)
+            .where(User.id.in_(list(points)))
+            .values(**values)
+            .returning(User.id, User.eco_points)
+            .execution_options(synchronize_session=False)
+        ).all()
+        return {user_id: eco_points for user_id, eco_points in rows}
+    
+    @staticmethod
+    def _order_from_result(result: dict) -> Order:
+        return Order(
+            id=result["order_id"],
+            user_id=result["user_id"],
+            total_amount=result["total_amount"],
+            eco_fee_total=result["eco_fee_total"],
+            status=result["status"],
+            created_at=datetime.fromisoformat(result["created_at"]),
+        )
+    
+    def _apply_order_to_stats(self, session: Session, user_id: int, order: Order, eco_items: int):
+        """Учесть заказ в user_stats (в транзакции заказа)"""
+        session.flush()
+        result = session.execute(
+            update(UserStats)
+            .where(UserStats.user_id == user_id)
+            .values(
+                total_orders=UserStats.total_orders + 1,
+                total_spent=UserStats.total_spent + order.total_amount + order.eco_fee_total,
+                eco_fee_paid=UserStats.eco_fee_paid + order.eco_fee_total,
+                eco_items=UserStats.eco_items + eco_items,
+                last_order_at=order.created_at,
+            )
+        )
+        if result.rowcount == 0:
+            # Первый заказ после появления user_stats: считаем агрегат по всем
+            # заказам пользователя (включая текущий) один раз
+            session.execute(insert(UserStats), [self._aggregate_user_stats(session, [user_id]).get(
+                user_id, {"user_id": user_id})])
+    
+    def _aggregate_user_stats(self, session: Session, user_ids: List[int] = None) -> Dict[int, dict]:
+        """Посчитать агрегаты user_stats по таблицам заказов"""
+        orders_query = session.query(
+            Order.user_id,
+            func.count(Order.id),
+            func.coalesce(func.sum(Order.total_amount + Order.eco_fee_total), 0),
+            func.coalesce(func.sum(Order.eco_fee_total), 0),
+            func.max(Order.created_at),
+        ).group_by(Order.user_id)
+        items_query = session.query(
+            Order.user_id,
+            func.coalesce(func.sum(case((OrderItem.eco_packaging, OrderItem.quantity), else_=0)), 0),
+        ).join(OrderItem, OrderItem.order_id == Order.id).group_by(Order.user_id)
+        if user_ids is not None:
+            orders_query = orders_query.filter(Order.user_id.in_(user_ids))
+            items_query = items_query.filter(Order.user_id.in_(user_ids))
+        
+        stats = {}
+        for user_id, total_orders, total_spent, eco_fee_paid, last_order_at in orders_query:
+            stats[user_id] = {
+                "user_id": user_id,
+                "total_orders": total_orders,
+                "total_spent": total_spent,
+                "eco_fee_paid": eco_fee_paid,
+                "eco_items": 0,
+                "last_order_at": last_order_at,
+            }
+        for user_id, eco_items in items_query:
+            if user_id in stats:
+                stats[user_id]["eco_items"] = eco_items
+        return stats
+    
+    def _backfill_user_stats(self):
+        """Заполнить user_stats при первом запуске на БД с заказами (обновление со старой версии)"""
         session = self.get_session()
+        empty = session.query(UserStats.user_id).first() is None
+        has_orders = empty and session.query(Order.id).first() is not None
+        session.close()
+        if has_orders:
+            self.rebuild_user_stats()
+    
+    def rebuild_user_stats(self) -> int:
+        """Пересчитать user_stats по всем заказам; возвращает число пользователей"""
+        session = self.get_session()
+        stats = self._aggregate_user_stats(session)
+        session.execute(delete(UserStats))
+        if stats:
+            session.execute(insert(UserStats), list(stats.values()))
+        session.commit()
+        session.close()
+        return len(stats)
+    
+    def create_orders_bulk(self, orders: List[dict]) -> List[dict]:
+        """Создать много заказов одной транзакцией
+        orders: список {"telegram_id": int, "items": [{"dish_id", "quantity", "eco_packaging"}]}
         
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
+        Каждый заказ проверяется отдельно; ошибочные пропускаются и попадают в
+        результат со статусом "error". Заказы и позиции вставляются пакетными
+        INSERT, EcoPoints и статистика применяются одной записью на пользователя.
+        Возвращает результат для каждого заказа в порядке входного списка.
+        """
+        session = self.get_session()
+        
+        telegram_ids = {order.get("telegram_id") for order in orders}
+        users = {}
+        if telegram_ids:
+            users = dict(session.query(User.telegram_id, User.id).filter(User.telegram_id.in_(telegram_ids)))
+        dishes = self._load_dishes(session, [order.get("items") or [] for order in orders])
+        
+        results = []
+        accepted = []  # (индекс результата, users.id, строки позиций, строка заказа, экопозиций)
+        for index, order in enumerate(orders):
+            user_id = users.get(order.get("telegram_id"))
+            items = order.get("items") or []
+            try:
+                if not user_id:
+                    raise ValueError("User not found")
+                if not items:
+                    raise ValueError("Order has no items")
+                item_rows, total_amount, eco_fee_total, eco_count = self._price_items(items, dishes, strict=True)
+            except ValueError as e:
+                results.append({"index": index, "status": "error", "error": str(e)})
+                continue
+            except (KeyError, TypeError) as e:
+                results.append({"index": index, "status": "error", "error": f"Invalid item: {e}"})
+                continue
+            
+            order_row = {
+                "user_id": user_id,
+                "total_amount": total_amount,
+                "eco_fee_total": eco_fee_total,
+                "status": "completed",
+                "created_at": datetime.utcnow(),
+            }
+            results.append({
+                "index": index,
+                "status": "ok",
+                "order_id": None,
+                "total_amount": total_amount,
+                "eco_fee_total": eco_fee_total,
+                "eco_points_earned": eco_count * 10,
+            })
+            accepted.append((len(results) - 1, user_id, item_rows, order_row, eco_count))
+        
+        if not accepted:
             session.close()
-            return
+            return results
         
-        user.eco_points += amount
-        eco_point = EcoPoint(user_id=user.id, amount=amount, reason=reason)
-        session.add(eco_point)
+        # Пакетный INSERT ... RETURNING: порядок возвращаемых строк БД не
+        # гарантирует, sort_by_parameter_order сопоставляет id с входными строками
+        # (PostgreSQL — пакетом, SQLite — построчно)
+        order_ids = session.scalars(
+            insert(Order).returning(Order.id, sort_by_parameter_order=True),
+            [order_row for _, _, _, order_row, _ in accepted],
+        ).all()
+        
+        all_item_rows = []
+        per_user = {}
+        for order_id, (result_index, user_id, item_rows, order_row, eco_count) in zip(order_ids, accepted):
+            results[result_index]["order_id"] = order_id
+            for row in item_rows:
+                row["order_id"] = order_id
+            all_item_rows.extend(item_rows)
+            
+            totals = per_user.setdefault(user_id, {
+                "orders": 0, "points": 0, "spent": 0,
+                "eco_fee": 0, "eco_items": 0, "last_order_at": None,
+            })
+            totals["orders"] += 1
+            totals["points"] += eco_count * 10
+            totals["spent"] += order_row["total_amount"] + order_row["eco_fee_total"]
+            totals["eco_fee"] += order_row["eco_fee_total"]
+            totals["eco_items"] += eco_count
+            totals["last_order_at"] = order_row["created_at"]
+        
+        if all_item_rows:
+            session.execute(insert(OrderItem), all_item_rows)
+        
+        # EcoPoints и счётчики заказов — один UPDATE на всех пользователей
+        new_points = self._credit_users(
+            session,
+            {user_id: totals["points"] for user_id, totals in per_user.items()},
+            {user_id: totals["orders"] for user_id, totals in per_user.items()},
+        )
+        session.add_all([
+            EcoPoint(user_id=user_id, amount=totals["points"], reason="eco_packaging")
+            for user_id, totals in per_user.items()
+        ])
+        session.flush()
+        
+        # Статистика: существующие строки увеличиваем пачкой (прибавление в SQL,
+        # как и баллы), недостающие считаем по заказам
+        existing_ids = {
+            user_id for (user_id,) in
+            session.query(UserStats.user_id).filter(UserStats.user_id.in_(list(per_user)))
+        }
+        if existing_ids:
+            stats = UserStats.__table__
+            session.execute(
+                update(stats)
+                .where(stats.c.user_id == bindparam("stats_user_id"))
+                .values(
+                    total_orders=stats.c.total_orders + bindparam("orders"),
+                    total_spent=stats.c.total_spent + bindparam("spent"),
+                    eco_fee_paid=stats.c.eco_fee_paid + bindparam("eco_fee"),
+                    eco_items=stats.c.eco_items + bindparam("eco_items"),
+                    last_order_at=bindparam("last_order_at"),
+                ),
+                [
+                    {"stats_user_id": user_id, **{key: per_user[user_id][key] for key in
+                                                  ("orders", "spent", "eco_fee", "eco_items", "last_order_at")}}
+                    for user_id in existing_ids
+                ],
+            )
+        missing = [user_id for user_id in per_user if user_id not in existing_ids]
+        if missing:
+            session.execute(insert(UserStats), list(self._aggregate_user_stats(session, missing).values()))
+        
+        session.commit()
+        session.close()
+        
+        for user_id, totals in per_user.items():
+            self.leaderboard.record_change(new_points[user_id] - totals["points"], new_points[user_id])
+        return results
+    
+    def get_user_orders(self, telegram_id: int, limit: int = 20, cursor: str = None) -> Optional[dict]:
+        """История заказов пользователя, от новых к старым
+        
+        Постраничная выборка по ключу (created_at, id): страница читается одним
+        запросом вместе с позициями и не зависит от глубины листания.
+        cursor — значение next_cursor предыдущей страницы.
+        Возвращает {"items": [...], "next_cursor": str | None} или None, если
+        пользователя нет.
+        """
+        session = self.get_session()
+        
+        query = (
+            session.query(Order)
+            .join(User, User.id == Order.user_id)
+            .filter(User.telegram_id == telegram_id)
+        )
+        if cursor:
+            created_at, order_id = decode_order_cursor(cursor)
+            query = query.filter(tuple_(Order.created_at, Order.id) < (created_at, order_id))
+        orders = (
+            query.options(joinedload(Order.items))
+            .order_by(Order.created_at.desc(), Order.id.desc())
+            .limit(limit + 1)
+            .all()
+        )
+        
+        if not orders and not cursor:
+            exists = session.query(User.id).filter(User.telegram_id == telegram_id).first()
+            if not exists:
+                session.close()
+                return None
+        
+        page = orders[:limit]
+        result = {
+            "items": [
+                {
+                    "id": order.id,
+                    "user_id": order.user_id,
+                    "total_amount": order.total_amount,
+                    "eco_fee_total": order.eco_fee_total,
+                    "status": order.status,
+                    "created_at": order.created_at,
+                    "items": [
+                        {
+                            "id": item.id,
+                            "dish_id": item.dish_id,
+                            "quantity": item.quantity,
+                            "price": item.price,
+                            "eco_packaging": item.eco_packaging,
+                            "eco_fee": item.eco_fee,
+                        }
+                        for item in sorted(order.items, key=lambda item: item.id)
+                    ],
+                }
+                for order in page
+            ],
+            "next_cursor": encode_order_cursor(page[-1]) if len(orders) > limit else None,
+        }
+        session.close()
+        return result
+    
+    def add_eco_points(self, telegram_id: int, amount: int, reason: str,
+                       idempotency_key: str = None) -> Optional[int]:
+        """Добавить eco points
+        Возвращает новый баланс или None, если пользователь не найден.
+        Повтор с тем же idempotency_key не начисляет баллы заново и возвращает
+        исходный баланс.
+        """
+        return self.add_eco_points_bulk([(telegram_id, amount, reason)], [idempotency_key])[0]
+    
+    def add_eco_points_bulk(self, accruals: List[Tuple[int, int, str]],
+                            idempotency_keys: List[Optional[str]] = None) -> List[Optional[int]]:
+        """Начислить eco points многим пользователям одной транзакцией
+        accruals: список (telegram_id, amount, reason)
+        idempotency_keys: ключи идемпотентности в том же порядке (None — без ключа)
+        
+        Возвращает баланс после каждого начисления (в порядке входного списка)
+        или None для неизвестного пользователя. Пользователи читаются одним
+        запросом IN, балансы увеличиваются одним UPDATE ... RETURNING.
+        """
+        if not accruals:
+            return []
+        keys = [
+            self._idempotency_key("eco_points", telegram_id, key)
+            for (telegram_id, _, _), key in zip(accruals, idempotency_keys or [None] * len(accruals))
+        ]
+        try:
+            return self._add_eco_points_bulk(accruals, keys)
+        except IntegrityError:
+            # Параллельный запрос записал тот же ключ: повтор найдёт его результат
+            return self._add_eco_points_bulk(accruals, keys)
+    
+    def _add_eco_points_bulk(self, accruals: List[Tuple[int, int, str]], keys: List[Optional[str]]) -> List[Optional[int]]:
+        session = self.get_session()
+        
+        stored = self._idempotency_lookup(session, [key for key in keys if key])
+        telegram_ids = {
+            telegram_id for (telegram_id, _, _), key in zip(accruals, keys) if key not in stored
+        }
+        users = {}
+        if telegram_ids:
+            users = dict(session.query(User.telegram_id, User.id).filter(User.telegram_id.in_(telegram_ids)))
+        
+        balances: List[Optional[int]] = []
+        applied = []  # (индекс в balances, users.id, amount, ключ)
+        repeated = []  # (индекс в balances, индекс первого начисления с тем же ключом)
+        first_by_key = {}
+        totals: Dict[int, int] = {}
+        ledger_rows = []
+        for (telegram_id, amount, reason), key in zip(accruals, keys):
+            index = len(balances)
+            balances.append(None)
+            if key in stored:
+                balances[index] = stored[key]["balance"]
+                continue
+            if key in first_by_key:
+                # Повтор ключа внутри той же пачки тоже не начисляет заново
+                repeated.append((index, first_by_key[key]))
+                continue
+            user_id = users.get(telegram_id)
+            if not user_id:
+                continue
+            if key:
+                first_by_key[key] = index
+            applied.append((index, user_id, amount, key))
+            totals[user_id] = totals.get(user_id, 0) + amount
+            ledger_rows.append({"user_id": user_id, "amount": amount, "reason": reason})
+        
+        try:
+            if ledger_rows:
+                new_points = self._credit_users(session, totals)
+                # Баланс после каждого начисления: от баланса до пачки по порядку
+                running = {user_id: new_points[user_id] - total for user_id, total in totals.items()}
+                for index, user_id, amount, key in applied:
+                    running[user_id] += amount
+                    balances[index] = running[user_id]
+                    if key:
+                        self._idempotency_store(session, key, "eco_points", {"balance": balances[index]})
+                for index, first in repeated:
+                    balances[index] = balances[first]
+                session.execute(insert(EcoPoint), ledger_rows)
+                session.commit()
+                for user_id, total in totals.items():
+                    self.leaderboard.record_change(new_points[user_id] - total, new_points[user_id])
+        finally:
+            session.close()
+        return balances
+    
+    # === IDEMPOTENCY ===
+    @staticmethod
+    def _idempotency_key(scope: str, telegram_id: int, key: Optional[str]) -> Optional[str]:
+        """Ключ в таблице: операция и пользователь + ключ клиента"""
+        return f"{scope}:{telegram_id}:{key}" if key else None
+    
+    def _idempotency_lookup(self, session: Session, keys: List[str]) -> Dict[str, dict]:
+        """Сохранённые результаты по ключам (один запрос по первичному ключу)
+        Просроченные записи удаляются, чтобы ключ можно было использовать снова.
+        """
+        if not keys:
+            return {}
+        now = datetime.utcnow()
+        results = {}
+        expired = False
+        for row in session.query(IdempotencyKey).filter(IdempotencyKey.key.in_(keys)):
+            if row.expires_at <= now:
+                session.delete(row)
+                expired = True
+            else:
+                results[row.key] = json.loads(row.result)
+        if expired:
+            session.flush()
+        return results
+    
+    def _idempotency_store(self, session: Session, key: str, scope: str, result: dict):
+        """Запомнить результат в транзакции операции"""
+        now = datetime.utcnow()
+        session.add(IdempotencyKey(
+            key=key,
+            scope=scope,
+            result=json.dumps(result),
+            created_at=now,
+            expires_at=now + timedelta(seconds=self.idempotency_ttl),
+        ))
+    
+    def purge_idempotency_keys(self) -> int:
+        """Удалить просроченные ключи идемпотентности; возвращает число удалённых"""
+        session = self.get_session()
+        result = session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow())
+        )
         session.commit()
         session.close()
+        return result.rowcount
     
     # === STATS METHODS ===
     def get_user_stats(self, telegram_id: int) -> dict:
-        """Получить статистику пользователя"""
+        """Получить статистику пользователя (одно чтение по индексу)
+        Если строки user_stats нет, а заказы есть, она считается по заказам и сохраняется.
+        """
         session = self.get_session()
         
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
+        row = (
+            session.query(
+                User.id,
+                User.eco_points,
+                User.orders_count,
+                UserStats.user_id.label("stats_user_id"),
+                UserStats.total_orders,
+                UserStats.total_spent,
+                UserStats.eco_fee_paid,
+                UserStats.eco_items,
+                UserStats.last_order_at,
+            )
+            .outerjoin(UserStats, UserStats.user_id == User.id)
+            .filter(User.telegram_id == telegram_id)
+            .first()
+        )
+        if not row:
             session.close()
             return {}
         
-        total_spent = session.query(Order).filter(Order.user_id == user.id).count()
-        eco_points = user.eco_points
-        orders_count = user.orders_count
+        stats = row._asdict()
+        if row.stats_user_id is None and row.orders_count:
+            aggregated = self._aggregate_user_stats(session, [row.id]).get(row.id)
+            if aggregated:
+                stats.update(aggregated)
+                try:
+                    session.execute(insert(UserStats), [aggregated])
+                    session.commit()
+                except IntegrityError:
+                    # Строку успел создать параллельный заказ
+                    session.rollback()
+        session.close()
         
-        stats = {
+        return {
+            "eco_points": stats["eco_points"],
+            "orders_count": stats["orders_count"],
+            "total_orders": stats["total_orders"] or 0,
+            "total_spent": stats["total_spent"] or 0,
+            "eco_fee_paid": stats["eco_fee_paid"] or 0,
+            "eco_items": stats["eco_items"] or 0,
+            "last_order_at": stats["last_order_at"],
+        }
+    
+    # === LEADERBOARD METHODS ===
+    def _load_points_histogram(self) -> List[Tuple[int, int]]:
+        """Число пользователей по каждому балансу (используется Leaderboard)"""
+        session = self.get_session()
+        rows = session.query(User.eco_points, func.count(User.id)).group_by(User.eco_points).all()
+        session.close()
+        return [(points or 0, count) for points, count in rows]
+    
+    def get_leaderboard(self, limit: int = 10) -> List[dict]:
+        """Топ пользователей по EcoPoints"""
+        session = self.get_session()
+        rows = (
+            session.query(User.telegram_id, User.username, User.eco_points)
+            .order_by(User.eco_points.desc(), User.id)
+            .limit(limit)
+            .all()
+        )
+        session.close()
+        return [
+            {
+                "rank": self.leaderboard.rank(row.eco_points or 0),
+                "telegram_id": row.telegram_id,
+                "username": row.username,
+                "eco_points": row.eco_points or 0,
+            }
+            for row in rows
+        ]
+    
+    def get_user_rank(self, telegram_id: int) -> Optional[dict]:
+        """Место пользователя в рейтинге EcoPoints"""
+        user = self.get_user(telegram_id)
+        if not user:
+            return None
+        eco_points = user["eco_points"] or 0
+        return {
+            "telegram_id": telegram_id,
+            "username": user["username"],
             "eco_points": eco_points,
-            "orders_count": orders_count,
-            "total_orders": total_spent
+            "rank": self.leaderboard.rank(eco_points),
+            "total_users": self.leaderboard.total_users(),
         }
-        
+    
+    # === KEY-VALUE METHODS ===
+    @staticmethod
+    def _kv_live(now: datetime):
+        return or_(KVEntry.expires_at.is_(None), KVEntry.expires_at > now)
+    
+    @staticmethod
+    def _kv_expires_at(now: datetime, ttl: Optional[float]) -> Optional[datetime]:
+        return now + timedelta(seconds=ttl) if ttl else None
+    
+    def kv_get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Получить значения по ключам (отсутствующие и просроченные ключи не возвращаются)"""
+        if not keys:
+            return {}
+        session = self.get_session()
+        rows = (
+            session.query(KVEntry.key, KVEntry.value)
+            .filter(KVEntry.key.in_(keys), self._kv_live(datetime.utcnow()))
+            .all()
+        )
         session.close()
-        return stats
+        return {key: value for key, value in rows}
+    
+    def kv_write_many(self, values: Dict[str, Optional[str]], ttl: float = None):
+        """Записать пачку значений одной транзакцией; None удаляет ключ
+        ttl: через сколько секунд без записи ключ считается удалённым (None — бессрочно)
+        """
+        if not values:
+            return
+        now = datetime.utcnow()
+        session = self.get_session()
+        session.execute(delete(KVEntry).where(KVEntry.key.in_(list(values))))
+        rows = [
+            {"key": key, "value": value, "updated_at": now, "expires_at": self._kv_expires_at(now, ttl)}
+            for key, value in values.items()
+            if value is not None
+        ]
+        if rows:
+            session.execute(insert(KVEntry), rows)
+        session.commit()
+        session.close()
+    
+    def kv_append(self, key: str, item: str, ttl: float = None):
+        """Дописать элемент (JSON) в JSON-список по ключу
+        Один атомарный UPDATE без чтения, поэтому параллельные дописывания из
+        разных воркеров не теряют друг друга; отсутствующий (или просроченный)
+        ключ создаётся заново.
+        """
+        now = datetime.utcnow()
+        expires_at = self._kv_expires_at(now, ttl)
+        appended = func.substr(KVEntry.value, 1, func.length(KVEntry.value) - 1, type_=Text) + f",{item}]"
+        session = self.get_session()
+        try:
+            for _ in range(2):
+                result = session.execute(
+                    update(KVEntry)
+                    .where(KVEntry.key == key, self._kv_live(now))
+                    .values(value=appended, updated_at=now, expires_at=expires_at)
+                )
+                if result.rowcount:
+                    session.commit()
+                    return
+                try:
+                    session.execute(delete(KVEntry).where(KVEntry.key == key, KVEntry.expires_at <= now))
+                    session.execute(insert(KVEntry).values(key=key, value=f"[{item}]", updated_at=now,
+                                                           expires_at=expires_at))
+                    session.commit()
+                    return
+                except IntegrityError:
+                    # Ключ успел создать другой воркер — дописываем в его список
+                    session.rollback()
+            raise RuntimeError(f"kv_append failed for {key}")
+        finally:
+            session.close()
+    
+    def purge_kv_store(self) -> int:
+        """Удалить просроченные ключи (брошенные корзины и FSM); возвращает число удалённых"""
+        session = self.get_session()
+        result = session.execute(delete(KVEntry).where(KVEntry.expires_at <= datetime.utcnow()))
+        session.commit()
+        session.close()
+        return result.rowcount
+    
+    # === BROADCAST METHODS ===
+    @staticmethod
+    def _broadcast_dict(broadcast: Broadcast) -> dict:
+        return {
+            "id": broadcast.id,
+            "text": broadcast.text,
+            "parse_mode": broadcast.parse_mode,
+            "status": broadcast.status,
+            "recipients": broadcast.recipients,
+            "max_user_id": broadcast.max_user_id,
+            "last_user_id": broadcast.last_user_id,
+            "delivered": broadcast.delivered,
+            "failed": broadcast.failed,
+            "created_at": broadcast.created_at,
+            "updated_at": broadcast.updated_at,
+            "finished_at": broadcast.finished_at,
+        }
+    
+    def create_broadcast(self, text: str, parse_mode: Optional[str] = "HTML") -> dict:
+        """Создать рассылку всем пользователям
+        Получатели фиксируются при создании: users.id не больше текущего
+        максимального, поэтому recipients совпадает с числом отправок.
+        """
+        session = self.get_session()
+        recipients, max_user_id = session.query(func.count(User.id), func.max(User.id)).one()
+        broadcast = Broadcast(
+            text=text,
+            parse_mode=parse_mode,
+            status="pending",
+            recipients=recipients,
+            max_user_id=max_user_id or 0,
+            last_user_id=0,
+            delivered=0,
+            failed=0,
+        )
+        session.add(broadcast)
+        session.commit()
+        result = self._broadcast_dict(broadcast)
+        session.close()
+        return result
+    
+    def get_broadcast(self, broadcast_id: int) -> Optional[dict]:
+        session = self.get_session()
+        broadcast = session.get(Broadcast, broadcast_id)
+        result = self._broadcast_dict(broadcast) if broadcast else None
+        session.close()
+        return result
+    
+    def get_broadcasts(self, statuses: List[str] = None, limit: int = 20) -> List[dict]:
+        """Последние рассылки (можно отфильтровать по статусу)"""
+        session = self.get_session()
+        query = session.query(Broadcast)
+        if statuses:
+            query = query.filter(Broadcast.status.in_(statuses))
+        result = [self._broadcast_dict(b) for b in query.order_by(Broadcast.id.desc()).limit(limit)]
+        session.close()
+        return result
+    
+    def get_broadcast_recipients(self, after_user_id: int, limit: int,
+                                 max_user_id: int = None) -> List[Tuple[int, int]]:
+        """Следующая пачка получателей (users.id, telegram_id) после after_user_id
+        Keyset-пагинация по первичному ключу: каждая пачка читается по индексу,
+        без OFFSET. max_user_id — верхняя граница, зафиксированная при создании рассылки.
+        """
+        session = self.get_session()
+        query = session.query(User.id, User.telegram_id).filter(User.id > after_user_id)
+        if max_user_id is not None:
+            query = query.filter(User.id <= max_user_id)
+        rows = query.order_by(User.id).limit(limit).all()
+        session.close()
+        return [(user_id, telegram_id) for user_id, telegram_id in rows]
+    
+    def claim_broadcast(self, broadcast_id: int, lease: float) -> Optional[dict]:
+        """Взять рассылку в работу; None, если её уже отправляет другой процесс
+        Забрать можно ожидающую рассылку или «зависшую»: running без сохранения
+        прогресса дольше lease секунд (процесс упал, не отпустив её).
+        """
+        now = datetime.utcnow()
+        session = self.get_session()
+        claimed = session.execute(
+            update(Broadcast)
+            .where(
+                Broadcast.id == broadcast_id,
+                or_(
+                    Broadcast.status == "pending",
+                    (Broadcast.status == "running") & (Broadcast.updated_at < now - timedelta(seconds=lease)),
+                ),
+            )
+            .values(status="running", updated_at=now)
+        ).rowcount
+        session.commit()
+        result = self._broadcast_dict(session.get(Broadcast, broadcast_id)) if claimed else None
+        session.close()
+        return result
+    
+    def save_broadcast_progress(self, broadcast_id: int, last_user_id: int = None, delivered: int = None,
+                                failed: int = None, status: str = None) -> Optional[dict]:
+        """Сохранить прогресс рассылки; возвращает её текущее состояние
+        Отменённую рассылку прогресс не возобновляет: статус cancelled остаётся.
+        """
+        session = self.get_session()
+        broadcast = session.get(Broadcast, broadcast_id)
+        if not broadcast:
+            session.close()
+            return None
+        if last_user_id is not None:
+            broadcast.last_user_id = last_user_id
+        if delivered is not None:
+            broadcast.delivered = delivered
+        if failed is not None:
+            broadcast.failed = failed
+        if status is not None and broadcast.status != "cancelled":
+            broadcast.status = status
+            if status in ("completed", "cancelled"):
+                broadcast.finished_at = datetime.utcnow()
+        broadcast.updated_at = datetime.utcnow()
+        session.commit()
+        result = self._broadcast_dict(broadcast)
+        session.close()
+        return result
+
+class AsyncDatabaseService:
+    """Асинхронная обёртка над DatabaseService для async-кода (FastAPI, aiogram).
+
+    Блокирующие вызовы SQLAlchemy выполняются в ограниченном пуле потоков,
+    поэтому медленный коммит не останавливает event loop.
+
+    max_pending ограничивает число вызовов, ожидающих или выполняющихся в пуле:
+    при всплеске нагрузки новые корутины ждут свободного слота, а не копят
+    неограниченную очередь в executor.
+
+    SQLite допускает одного писателя на файл, поэтому пишущие методы для него
+    выполняются по одному в отдельном потоке: потоки процесса не ждут друг
+    друга на блокировке файла (busy_timeout), а чтения идут параллельно.
+    """
+
+    def __init__(self, db: DatabaseService, max_workers: int = None, max_pending: int = None):
+        self.db = db
+        if max_workers is None:
+            max_workers = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+        if max_pending is None:
+            max_pending = int(os.getenv("DB_MAX_PENDING", str(max_workers * 8)))
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ecoeats-db")
+        self.writer = self.executor
+        if db.engine.dialect.name == "sqlite":
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ecoeats-db-writer")
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def _run(self, func, *args, **kwargs):
+        """Выполнить синхронный метод БД в пуле потоков"""
+        return await self._call(self.executor, func, *args, **kwargs)
+
+    async def _write(self, func, *args, **kwargs):
+        """Выполнить пишущий метод БД (для SQLite — в единственном потоке записи)"""
+        return await self._call(self.writer, func, *args, **kwargs)
+
+    async def _call(self, executor: ThreadPoolExecutor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            async with self._slots:
+                self.pending += 1
+                try:
+                    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+                finally:
+                    self.pending -= 1
+        finally:
+            # Время БД с учётом ожидания слота: именно его видит вызывающий код
+            record_db_time(func.__name__, time.perf_counter() - started)
+
+    def close(self):
+        """Остановить пул потоков, дождавшись текущих запросов"""
+        self.executor.shutdown(wait=True)
+        if self.writer is not self.executor:
+            self.writer.shutdown(wait=True)
+
+    # === USER METHODS ===
+    async def get_or_create_user(self, telegram_id: int, username: str = None) -> dict:
+        return await self._run(self.db.get_or_create_user, telegram_id, username)
+
+    async def get_user(self, telegram_id: int) -> dict:
+        return await self._run(self.db.get_user, telegram_id)
+
+    # === MENU METHODS ===
+    async def _read_menu(self, func, *args):
+        """Чтение меню: из свежего кэша напрямую, иначе загрузка в пуле потоков"""
+        if self.db.menu.is_fresh():
+            return func(*args)
+        return await self._run(func, *args)
+
+    async def get_menu(self) -> MenuSnapshot:
+        return await self._read_menu(self.db.get_menu)
+
+    async def add_restaurant(self, name: str, emoji: str, description: str = None) -> MenuRestaurant:
+        return await self._write(self.db.add_restaurant, name, emoji, description)
+
+    async def add_dish(self, restaurant_id: int, name: str, price: float, description: str = None) -> MenuDish:
+        return await self._write(self.db.add_dish, restaurant_id, name, price, description)
+
+    # === RESTAURANT METHODS ===
+    async def get_restaurants(self) -> List[MenuRestaurant]:
+        return await self._read_menu(self.db.get_restaurants)
+
+    async def get_restaurant(self, restaurant_id: int) -> Optional[MenuRestaurant]:
+        return await self._read_menu(self.db.get_restaurant, restaurant_id)
+
+    async def get_restaurant_by_name(self, name: str) -> Optional[MenuRestaurant]:
+        return await self._read_menu(self.db.get_restaurant_by_name, name)
+
+    # === DISH METHODS ===
+    async def get_dishes(self, restaurant_id: int) -> List[MenuDish]:
+        return await self._read_menu(self.db.get_dishes, restaurant_id)
+
+    async def get_dish(self, dish_id: int) -> Optional[MenuDish]:
+        return await self._read_menu(self.db.get_dish, dish_id)
+
+    # === CART/ORDER METHODS ===
+    async def create_order(self, telegram_id: int, items: List[dict], idempotency_key: str = None) -> Order:
+        return await self._write(self.db.create_order, telegram_id, items, idempotency_key)
+
+    async def create_orders_bulk(self, orders: List[dict]) -> List[dict]:
+        return await self._write(self.db.create_orders_bulk, orders)
+
+    async def get_user_orders(self, telegram_id: int, limit: int = 20, cursor: str = None) -> Optional[dict]:
+        return await self._run(self.db.get_user_orders, telegram_id, limit, cursor)
+
+    async def add_eco_points(self, telegram_id: int, amount: int, reason: str,
+                             idempotency_key: str = None) -> Optional[int]:
+        return await self._write(self.db.add_eco_points, telegram_id, amount, reason, idempotency_key)
+
+    async def add_eco_points_bulk(self, accruals: List[Tuple[int, int, str]],
+                                  idempotency_keys: List[Optional[str]] = None) -> List[Optional[int]]:
+        return await self._write(self.db.add_eco_points_bulk, accruals, idempotency_keys)
+
+    async def purge_idempotency_keys(self) -> int:
+        return await self._write(self.db.purge_idempotency_keys)
+
+    # === STATS METHODS ===
+    async def get_user_stats(self, telegram_id: int) -> dict:
+        return await self._run(self.db.get_user_stats, telegram_id)
+
+    async def rebuild_user_stats(self) -> int:
+        return await self._write(self.db.rebuild_user_stats)
+
+    # === LEADERBOARD METHODS ===
+    async def get_leaderboard(self, limit: int = 10) -> List[dict]:
+        return await self._run(self.db.get_leaderboard, limit)
+
+    async def get_user_rank(self, telegram_id: int) -> Optional[dict]:
+        return await self._run(self.db.get_user_rank, telegram_id)
+
+    # === KEY-VALUE METHODS ===
+    async def kv_get_many(self, keys: List[str]) -> Dict[str, str]:
+        return await self._run(self.db.kv_get_many, keys)
+
+    async def kv_write_many(self, values: Dict[str, Optional[str]], ttl: float = None):
+        return await self._write(self.db.kv_write_many, values, ttl)
+
+    async def kv_append(self, key: str, item: str, ttl: float = None):
+        return await self._write(self.db.kv_append, key, item, ttl)
+
+    async def purge_kv_store(self) -> int:
+        return await self._write(self.db.purge_kv_store)
+
+    # === BROADCAST METHODS ===
+    async def create_broadcast(self, text: str, parse_mode: Optional[str] = "HTML") -> dict:
+        return await self._write(self.db.create_broadcast, text, parse_mode)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[dict]:
+        return await self._run(self.db.get_broadcast, broadcast_id)
+
+    async def get_broadcasts(self, statuses: List[str] = None, limit: int = 20) -> List[dict]:
+        return await self._run(self.db.get_broadcasts, statuses, limit)
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int,
+                                       max_user_id: int = None) -> List[Tuple[int, int]]:
+        return await self._run(self.db.get_broadcast_recipients, after_user_id, limit, max_user_id)
+
+    async def claim_broadcast(self, broadcast_id: int, lease: float) -> Optional[dict]:
+        return await self._write(self.db.claim_broadcast, broadcast_id, lease)
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int = None, delivered: int = None,
+                                      failed: int = None, status: str = None) -> Optional[dict]:
+        return await self._write(self.db.save_broadcast_progress, broadcast_id, last_user_id, delivered,
+                                 failed, status)
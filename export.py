@@ -0,0 +1,144 @@
+"""
+Потоковая выгрузка заказов и журнала EcoPoints для аналитики
+
+Строки читаются из БД порциями (серверный курсор, yield_per) и сразу
+записываются, поэтому память не зависит от объёма выгрузки.
+
+Форматы: ndjson, csv и parquet (только в файл, нужен пакет pyarrow).
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, List
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, select
+
+from models import Order, OrderItem, EcoPoint
+
+EXPORT_TABLES = {
+    "orders": Order,
+    "order_items": OrderItem,
+    "eco_points": EcoPoint,
+}
+STREAM_FORMATS = ("ndjson", "csv")
+FILE_FORMATS = STREAM_FORMATS + ("parquet",)
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_columns(table: str) -> List[str]:
+    model = _get_model(table)
+    return [column.name for column in model.__table__.columns]
+
+
+def _get_model(table: str):
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table: {table}")
+    return EXPORT_TABLES[table]
+
+
+def iter_rows(engine, table: str, chunk_size: int = 1000) -> Iterator[List[dict]]:
+    """Строки таблицы порциями по chunk_size (по возрастанию id)"""
+    model = _get_model(table)
+    stmt = select(model.__table__).order_by(model.__table__.c.id)
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=chunk_size).execute(stmt)
+        for partition in result.partitions():
+            yield [dict(row._mapping) for row in partition]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson(chunks: Iterable[List[dict]]) -> Iterator[str]:
+    """По одной JSON-строке на запись; один фрагмент вывода на порцию"""
+    for rows in chunks:
+        yield "".join(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n" for row in rows)
+
+
+def iter_csv(chunks: Iterable[List[dict]], columns: List[str]) -> Iterator[str]:
+    """CSV с заголовком; один фрагмент вывода на порцию"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for rows in chunks:
+        for row in rows:
+            writer.writerow({key: value.isoformat() if isinstance(value, datetime) else value
+                             for key, value in row.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_export(engine, table: str, fmt: str, chunk_size: int = 1000) -> Iterator[str]:
+    """Текстовый поток выгрузки в формате ndjson или csv"""
+    chunks = iter_rows(engine, table, chunk_size)
+    if fmt == "ndjson":
+        return iter_ndjson(chunks)
+    if fmt == "csv":
+        return iter_csv(chunks, export_columns(table))
+    raise ValueError(f"Unsupported streaming format: {fmt}")
+
+
+def write_parquet(engine, table: str, path: str, chunk_size: int = 10000) -> int:
+    """Записать таблицу в Parquet порциями (row group на порцию)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Формат parquet требует пакет pyarrow (pip install pyarrow)")
+
+    # Схема берётся из модели, а не выводится по порции: иначе порция,
+    # где столбец целиком NULL, получит другой тип
+    arrow_types = {
+        Integer: pa.int64(),
+        Float: pa.float64(),
+        Boolean: pa.bool_(),
+        DateTime: pa.timestamp("us"),
+    }
+    schema = pa.schema([
+        (column.name, next((arrow_type for sql_type, arrow_type in arrow_types.items()
+                            if isinstance(column.type, sql_type)), pa.string()))
+        for column in _get_model(table).__table__.columns
+    ])
+
+    rows_written = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in iter_rows(engine, table, chunk_size):
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            rows_written += len(rows)
+    return rows_written
+
+
+def export_to_file(engine, table: str, fmt: str, path: str, chunk_size: int = 10000) -> int:
+    """Выгрузить таблицу в файл; возвращает число строк"""
+    if fmt == "parquet":
+        return write_parquet(engine, table, path, chunk_size)
+
+    counted = []
+
+    def counting(chunks):
+        for rows in chunks:
+            counted.append(len(rows))
+            yield rows
+
+    chunks = counting(iter_rows(engine, table, chunk_size))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if fmt == "ndjson":
+            parts = iter_ndjson(chunks)
+        elif fmt == "csv":
+            parts = iter_csv(chunks, export_columns(table))
+        else:
+            raise ValueError(f"Unknown format: {fmt}")
+        for part in parts:
+            f.write(part)
+    return sum(counted)
@@ -0,0 +1,139 @@
+"""
+Inline-клавиатуры бота EcoEats.
+
+Клавиатуры строятся один раз и переиспользуются: статические экраны живут
+всё время работы процесса, экраны меню — пока не изменится версия снимка
+меню (MenuSnapshot.version). Готовые объекты нельзя изменять.
+"""
+
+from typing import Dict, Tuple
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from database import MenuSnapshot
+
+
+# === ПОСТРОЕНИЕ КЛАВИАТУР ===
+def build_main_menu_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text="🍔 Меню ресторанов", callback_data="menu_restaurants")],
+        [InlineKeyboardButton(text="🛒 Корзина", callback_data="view_cart")],
+        [InlineKeyboardButton(text="🌿 Мои бонусы", callback_data="my_bonus")],
+        [InlineKeyboardButton(text="🏆 Рейтинг", callback_data="leaderboard")],
+        [InlineKeyboardButton(text="🔄 Возврат контейнеров", callback_data="return_containers")],
+        [InlineKeyboardButton(text="ℹ️ О сервисе", callback_data="about_service")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_restaurants_keyboard(snapshot: MenuSnapshot) -> InlineKeyboardMarkup:
+    keyboard = []
+    for rest in snapshot.restaurants:
+        keyboard.append([InlineKeyboardButton(
+            text=f"{rest.emoji} {rest.name}",
+            callback_data=f"rest|{rest.id}"
+        )])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_dishes_keyboard(snapshot: MenuSnapshot, restaurant_id: int) -> InlineKeyboardMarkup:
+    keyboard = []
+    for dish in snapshot.dishes_by_restaurant.get(restaurant_id, ()):
+        keyboard.append([InlineKeyboardButton(
+            text=f"{dish.name} – {dish.price}₸",
+            callback_data=f"dish|{restaurant_id}|{dish.id}"
+        )])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад к ресторанам", callback_data="menu_restaurants")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_packaging_keyboard(restaurant_id: int, dish_id: int) -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text="♻️ Да, в экоупаковке (+150₸)",
+                            callback_data=f"pack|eco|{restaurant_id}|{dish_id}")],
+        [InlineKeyboardButton(text="❌ Нет, обычная упаковка",
+                            callback_data=f"pack|regular|{restaurant_id}|{dish_id}")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_after_add_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text="➕ Добавить ещё", callback_data="menu_restaurants")],
+        [InlineKeyboardButton(text="🛒 Перейти в корзину", callback_data="view_cart")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_cart_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text="✔️ Оформить заказ", callback_data="checkout")],
+        [InlineKeyboardButton(text="❌ Очистить корзину", callback_data="clear_cart")],
+        [InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_main")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_back_button() -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(text="🔙 Главное меню", callback_data="back_to_main")]]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_return_containers_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text="📦 Я хочу вернуть контейнеры", callback_data="confirm_return")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# === РЕЕСТР ===
+class KeyboardRegistry:
+    """Реестр готовых клавиатур.
+
+    Клавиатуры меню кэшируются по ID ресторана/блюда и сбрасываются целиком,
+    когда меняется версия снимка меню.
+    """
+
+    def __init__(self):
+        self.main_menu = build_main_menu_keyboard()
+        self.after_add = build_after_add_keyboard()
+        self.cart = build_cart_keyboard()
+        self.back = build_back_button()
+        self.return_containers = build_return_containers_keyboard()
+
+        self.menu_version = None
+        self._restaurants = None
+        self._dishes: Dict[int, InlineKeyboardMarkup] = {}
+        self._packaging: Dict[Tuple[int, int], InlineKeyboardMarkup] = {}
+
+    def _sync(self, snapshot: MenuSnapshot):
+        """Сбросить клавиатуры меню, если снимок меню обновился"""
+        if snapshot.version != self.menu_version:
+            self._restaurants = None
+            self._dishes = {}
+            self._packaging = {}
+            self.menu_version = snapshot.version
+
+    def restaurants(self, snapshot: MenuSnapshot) -> InlineKeyboardMarkup:
+        self._sync(snapshot)
+        if self._restaurants is None:
+            self._restaurants = build_restaurants_keyboard(snapshot)
+        return self._restaurants
+
+    def dishes(self, snapshot: MenuSnapshot, restaurant_id: int) -> InlineKeyboardMarkup:
+        self._sync(snapshot)
+        keyboard = self._dishes.get(restaurant_id)
+        if keyboard is None:
+            keyboard = build_dishes_keyboard(snapshot, restaurant_id)
+            # Кэшируем только существующие рестораны, чтобы произвольные
+            # callback_data не раздували реестр
+            if restaurant_id in snapshot.restaurants_by_id:
+                self._dishes[restaurant_id] = keyboard
+        return keyboard
+
+    def packaging(self, snapshot: MenuSnapshot, restaurant_id: int, dish_id: int) -> InlineKeyboardMarkup:
+        self._sync(snapshot)
+        key = (restaurant_id, dish_id)
+        keyboard = self._packaging.get(key)
+        if keyboard is None:
+            keyboard = build_packaging_keyboard(restaurant_id, dish_id)
+            # Кэшируем только блюда этого ресторана: restaurant_id тоже
+            # приходит из callback_data
+            dish = snapshot.dishes_by_id.get(dish_id)
+            if dish is not None and dish.restaurant_id == restaurant_id:
+                self._packaging[key] = keyboard
+        return keyboard
@@ -0,0 +1,178 @@
+"""
+Рейтинг пользователей по EcoPoints
+
+Место пользователя = 1 + число пользователей с большим балансом. Для этого
+в памяти процесса хранится гистограмма балансов: отсортированные блоки
+различных значений баланса и дерево Фенвика над суммами блоков. Место
+считается за O(log D + BLOCK_SIZE), где D — число различных балансов, новые
+балансы добавляются без перестройки, и ничто не зависит ни от числа
+пользователей, ни от величины баланса. Гистограмма строится одним GROUP BY, дальше обновляется
+инкрементально при изменении баллов и периодически сверяется с БД
+(изменения, сделанные другими процессами).
+
+Топ рейтинга читается из БД по индексу users.eco_points.
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class PointsHistogram:
+    """Число пользователей по каждому значению баланса
+
+    Различные балансы хранятся отсортированными блоками по BLOCK_SIZE..2*BLOCK_SIZE
+    значений, над суммами блоков — дерево Фенвика. Новый баланс вставляется
+    в свой блок (bisect), переполненный блок делится пополам, и дерево
+    пересобирается только по суммам блоков. Память зависит от числа
+    различных балансов, а не от самого большого; место считается за
+    O(log D + BLOCK_SIZE), где D — число различных балансов.
+    """
+
+    BLOCK_SIZE = 128
+
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        self._blocks: List[List[int]] = []  # различные балансы по возрастанию
+        self._maxes: List[int] = []  # наибольший баланс каждого блока
+        self._block_totals: List[int] = []  # пользователей в каждом блоке
+        self._tree = [0]
+        self.total = 0
+
+    @classmethod
+    def from_counts(cls, counts: Iterable[Tuple[int, int]]) -> "PointsHistogram":
+        histogram = cls()
+        for points, count in counts:
+            points = max(points or 0, 0)
+            histogram._counts[points] = histogram._counts.get(points, 0) + count
+            histogram.total += count
+        histogram._counts = {points: count for points, count in histogram._counts.items() if count}
+        values = sorted(histogram._counts)
+        histogram._blocks = [values[i:i + cls.BLOCK_SIZE] for i in range(0, len(values), cls.BLOCK_SIZE)]
+        histogram._maxes = [block[-1] for block in histogram._blocks]
+        histogram._block_totals = [sum(histogram._counts[points] for points in block)
+                                   for block in histogram._blocks]
+        histogram._rebuild_tree()
+        return histogram
+
+    def _rebuild_tree(self):
+        size = len(self._block_totals)
+        tree = [0] * (size + 1)
+        for index, total in enumerate(self._block_totals, 1):
+            tree[index] += total
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self._tree = tree
+
+    def _insert(self, points: int):
+        """Добавить новое значение баланса (с нулевым числом пользователей)"""
+        self._counts[points] = 0
+        if not self._blocks:
+            self._blocks, self._maxes, self._block_totals = [[points]], [points], [0]
+            self._rebuild_tree()
+            return
+        index = bisect.bisect_left(self._maxes, points)
+        if index == len(self._blocks):
+            index -= 1
+            self._maxes[index] = points
+        block = self._blocks[index]
+        bisect.insort(block, points)
+        if len(block) > 2 * self.BLOCK_SIZE:
+            head, tail = block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]
+            head_total = sum(self._counts[value] for value in head)
+            self._blocks[index:index + 1] = [head, tail]
+            self._maxes[index:index + 1] = [head[-1], tail[-1]]
+            self._block_totals[index:index + 1] = [head_total, self._block_totals[index] - head_total]
+            self._rebuild_tree()
+
+    def add(self, points: int, delta: int = 1):
+        """Изменить число пользователей с балансом points на delta"""
+        points = max(points, 0)
+        if points not in self._counts:
+            self._insert(points)
+        self._counts[points] += delta
+        self.total += delta
+        block = bisect.bisect_left(self._maxes, points)
+        self._block_totals[block] += delta
+        index = block + 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def count_at_most(self, points: int) -> int:
+        """Число пользователей с балансом <= points"""
+        if points < 0:
+            return 0
+        # Блоки целиком не больше points — по дереву, следующий блок — частично
+        block = bisect.bisect_right(self._maxes, points)
+        index = block
+        result = 0
+        while index > 0:
+            result += self._tree[index]
+            index -= index & -index
+        if block < len(self._blocks):
+            values = self._blocks[block]
+            result += sum(self._counts[value] for value in values[:bisect.bisect_right(values, points)])
+        return result
+
+    def count_at(self, points: int) -> int:
+        return self._counts.get(points, 0) if points >= 0 else 0
+
+    def count_above(self, points: int) -> int:
+        """Число пользователей с балансом > points"""
+        return self.total - self.count_at_most(max(points, 0))
+
+
+class Leaderboard:
+    """Место в рейтинге по EcoPoints за O(log D + BLOCK_SIZE).
+
+    loader возвращает пары (eco_points, число пользователей) из БД.
+    """
+
+    def __init__(self, loader: Callable[[], List[Tuple[int, int]]], resync_interval: float = None):
+        self._loader = loader
+        if resync_interval is None:
+            resync_interval = float(os.getenv("LEADERBOARD_RESYNC", "300"))
+        self.resync_interval = resync_interval
+        self._histogram: Optional[PointsHistogram] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self) -> PointsHistogram:
+        if self._histogram is None or time.monotonic() - self._loaded_at > self.resync_interval:
+            histogram = PointsHistogram.from_counts(self._loader())
+            self._histogram = histogram
+            self._loaded_at = time.monotonic()
+        return self._histogram
+
+    def rank(self, points: int) -> int:
+        """Место пользователя с балансом points (1 — лучший)"""
+        with self._lock:
+            return self._ensure_loaded().count_above(points) + 1
+
+    def total_users(self) -> int:
+        with self._lock:
+            return self._ensure_loaded().total
+
+    def record_user(self, points: int = 0):
+        """Учесть нового пользователя"""
+        with self._lock:
+            if self._histogram is not None:
+                self._histogram.add(points, 1)
+
+    def record_change(self, old_points: int, new_points: int):
+        """Учесть изменение баланса пользователя"""
+        if old_points == new_points:
+            return
+        with self._lock:
+            if self._histogram is not None:
+                self._histogram.add(old_points, -1)
+                self._histogram.add(new_points, 1)
+
+    def invalidate(self):
+        """Перечитать гистограмму из БД при следующем запросе"""
+        with self._lock:
+            self._histogram = None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест REST API без внешних сервисов
+
+Поднимает api:app в этом же процессе (uvicorn) на временной БД, заполняет
+её синтетическими пользователями (benchmark.seed_dataset) и гоняет смесь
+запросов из --concurrency асинхронных клиентов aiohttp. Для каждого
+эндпоинта печатает число запросов, ошибки, запросов в секунду и
+перцентили задержки (JSON).
+
+Запуск:
+    python manage.py loadtest [--duration 10] [--concurrency 32]
+                              [--mix menu=40,user=30,order=20,points=10]
+                              [--users 1000] [--seed 42] [--db-url URL] [--out result.json]
+
+Клиенты и сервер делят один event loop, поэтому абсолютные цифры ниже, чем
+у отдельно запущенного сервера, но подходят для сравнения версий.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from profiling import percentile
+
+DEFAULT_MIX = "menu=40,user=30,order=20,points=10"
+OPERATIONS = ("menu", "user", "stats", "order", "points")
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """'menu=40,order=20' -> {"menu": 40, "order": 20}"""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name} (допустимо: {', '.join(OPERATIONS)})")
+        weights[name] = int(weight or 1)
+    if not any(weights.values()):
+        raise ValueError("Mix has no operations")
+    return weights
+
+
+class LoadStats:
+    """Задержки и ошибки по эндпоинтам"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "rps": round(len(latencies) / elapsed, 1),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "max_ms": round(max(latencies) * 1000, 2),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "duration_s": round(elapsed, 2),
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "rps": round(total / elapsed, 1),
+            "endpoints": endpoints,
+        }
+
+
+async def _client(session, base_url: str, rng: random.Random, weights: Dict[str, int], menu: dict,
+                  users: int, stats: LoadStats, deadline: float, budget: list):
+    names = list(weights)
+    cum_weights = list(weights.values())
+    restaurant_ids = list(menu)
+    dish_ids = [dish_id for dishes in menu.values() for dish_id in dishes]
+
+    while time.perf_counter() < deadline and budget[0] != 0:
+        if budget[0] > 0:
+            budget[0] -= 1
+        operation = rng.choices(names, weights=cum_weights)[0]
+        telegram_id = 10_000_000 + rng.randrange(users)
+        if operation == "menu":
+            endpoint = "GET /api/restaurants/{id}/dishes"
+            request = session.get(f"{base_url}/api/restaurants/{rng.choice(restaurant_ids)}/dishes")
+        elif operation == "user":
+            endpoint = "GET /api/users/{id}"
+            request = session.get(f"{base_url}/api/users/{telegram_id}")
+        elif operation == "stats":
+            endpoint = "GET /api/users/{id}/stats"
+            request = session.get(f"{base_url}/api/users/{telegram_id}/stats")
+        elif operation == "order":
+            endpoint = "POST /api/orders"
+            request = session.post(f"{base_url}/api/orders", json={
+                "telegram_id": telegram_id,
+                "items": [
+                    {"dish_id": rng.choice(dish_ids), "quantity": 1, "eco_packaging": rng.random() < 0.5}
+                    for _ in range(rng.randint(1, 5))
+                ],
+            })
+        else:
+            endpoint = "POST /api/eco-points/add"
+            request = session.post(f"{base_url}/api/eco-points/add", json={
+                "telegram_id": telegram_id, "amount": 5, "reason": "container_return",
+            })
+
+        started = time.perf_counter()
+        try:
+            async with request as response:
+                await response.read()
+                ok = response.status < 400
+        except Exception:
+            ok = False
+        stats.record(endpoint, time.perf_counter() - started, ok)
+
+
+async def run_loadtest(args) -> dict:
+    import aiohttp
+    import uvicorn
+
+    # api создаёт подключение к БД при импорте, поэтому окружение готовим заранее
+    import api
+    from benchmark import seed_dataset
+
+    dataset = seed_dataset(api.db, args.users, args.users, args.seed)
+    snapshot = api.db.get_menu()
+    menu = {restaurant.id: [dish.id for dish in snapshot.dishes_by_restaurant.get(restaurant.id, ())]
+            for restaurant in snapshot.restaurants}
+
+    config = uvicorn.Config(api.app, host="127.0.0.1", port=args.port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    stats = LoadStats()
+    weights = parse_mix(args.mix)
+    budget = [args.requests if args.requests else -1]
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.perf_counter()
+            deadline = started + (args.duration if not args.requests else float("inf"))
+            await asyncio.gather(*[
+                _client(session, base_url, random.Random(args.seed * 1000 + worker), weights, menu,
+                        args.users, stats, deadline, budget)
+                for worker in range(args.concurrency)
+            ])
+            elapsed = time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        await server_task
+
+    return {
+        "scenario": "loadtest",
+        "concurrency": args.concurrency,
+        "mix": weights,
+        "dataset": dataset,
+        "database": api.db.engine.dialect.name,
+        **stats.report(elapsed),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест REST API (в одном процессе)")
+    parser.add_argument("--duration", type=float, default=10, help="Секунд нагрузки")
+    parser.add_argument("--requests", type=int, default=0, help="Всего запросов (вместо --duration)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Параллельных клиентов")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Доли операций ({', '.join(OPERATIONS)})")
+    parser.add_argument("--users", type=int, default=1000, help="Пользователей (и заказов) в наборе данных")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=0, help="Порт сервера (0 — любой свободный)")
+    parser.add_argument("--db-url", help="URL БД; по умолчанию временный SQLite-файл")
+    parser.add_argument("--out", help="Записать JSON в файл вместо stdout")
+    args = parser.parse_args(argv)
+    parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = args.db_url or f"sqlite:///{os.path.join(tmp, 'loadtest.db')}"
+        # Несколько потоков пула пишут в SQLite одновременно: WAL и busy_timeout
+        os.environ.setdefault("DB_ENGINE_PROFILE", "concurrent")
+        report = asyncio.run(run_loadtest(args))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ Результат записан в {args.out}")
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,13 @@ import os
 import sys
 import subprocess
 import time
+from contextlib import nullcontext, redirect_stdout
 from pathlib import Path
 
+# Команды, которые печатают JSON-отчёт в stdout: меню для них уходит в stderr,
+# чтобы `python manage.py loadtest > report.json` давал валидный JSON
+REPORT_COMMANDS = {"9", "bench", "10", "loadtest", "11", "botsim"}
+
 def print_header(text):
     """Вывести заголовок"""
     print(f"\n{'='*50}")
@@ -21,7 +26,31 @@ def run_command(cmd, description):
     print(f"   Команда: {cmd}\n")
     subprocess.run(cmd, shell=True)
 
-def main():
+def export_data(args):
+    """Выгрузить таблицу в файл (NDJSON, CSV или Parquet)"""
+    import argparse
+    from database import DatabaseService
+    from export import EXPORT_TABLES, FILE_FORMATS, export_to_file
+    
+    parser = argparse.ArgumentParser(prog="manage.py export")
+    parser.add_argument("table", choices=list(EXPORT_TABLES))
+    parser.add_argument("--format", choices=FILE_FORMATS, default="ndjson")
+    parser.add_argument("--out", help="Файл выгрузки (по умолчанию <table>.<format>)")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    options = parser.parse_args(args)
+    
+    path = options.out or f"{options.table}.{options.format}"
+    db = DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db"))
+    started = time.time()
+    try:
+        rows = export_to_file(db.engine, options.table, options.format, path, options.chunk_size)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+    print(f"✅ {rows} строк выгружено в {path} за {time.time() - started:.1f} с")
+
+def print_menu():
+    """Вывести список команд"""
     print_header("🌱 EcoEats - Control Panel")
     
     print("Доступные команды:\n")
@@ -29,12 +58,24 @@ def main():
     print("2. api      - Запустить REST API")
     print("3. both     - Запустить оба сервиса")
     print("4. test     - Протестировать БД")
-    print("5. clean    - Очистить БД\n")
-    
+    print("5. clean    - Очистить БД")
+    print("6. rebuild-stats - Пересчитать статистику пользователей")
+    print("7. export   - Выгрузить orders / order_items / eco_points")
+    print("8. purge-idempotency - Удалить просроченные ключи идемпотентности")
+    print("9. bench    - Бенчмарк горячих путей БД (см. benchmark.py --help)")
+    print("10. loadtest - Нагрузочный тест REST API (см. loadtest.py --help)")
+    print("11. botsim  - Симуляция нагрузки на бота без Telegram (см. botsim.py --help)")
+    print("12. broadcast - Рассылка всем пользователям (см. broadcast.py --help)")
+    print("13. purge-kv - Удалить просроченные корзины и FSM-состояния (STORAGE_BACKEND=sql)\n")
+
+def main():
     if len(sys.argv) < 2:
-        command = input("Выберите команду (1-5): ").strip()
+        print_menu()
+        command = input("Выберите команду (1-13): ").strip()
     else:
         command = sys.argv[1]
+        with redirect_stdout(sys.stderr) if command in REPORT_COMMANDS else nullcontext():
+            print_menu()
     
     if command in ["1", "bot"]:
         run_command("python bot_with_db.py", "Запуск Telegram бота")
@@ -62,6 +103,43 @@ def main():
         else:
             print("❌ БД не найдена")
     
+    elif command in ["6", "rebuild-stats"]:
+        from database import DatabaseService
+        db = DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db"))
+        users = db.rebuild_user_stats()
+        print(f"✅ Статистика пересчитана для {users} пользователей")
+    
+    elif command in ["7", "export"]:
+        export_data(sys.argv[2:])
+    
+    elif command in ["8", "purge-idempotency"]:
+        from database import DatabaseService
+        db = DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db"))
+        keys = db.purge_idempotency_keys()
+        print(f"✅ Удалено просроченных ключей: {keys}")
+    
+    elif command in ["9", "bench"]:
+        import benchmark
+        benchmark.main(sys.argv[2:] or ["hotpaths"])
+    
+    elif command in ["10", "loadtest"]:
+        import loadtest
+        loadtest.main(sys.argv[2:])
+    
+    elif command in ["11", "botsim"]:
+        import botsim
+        botsim.main(sys.argv[2:])
+    
+    elif command in ["12", "broadcast"]:
+        import broadcast
+        broadcast.main(sys.argv[2:] or ["status"])
+    
+    elif command in ["13", "purge-kv"]:
+        from database import DatabaseService
+        db = DatabaseService(db_url=os.getenv("DATABASE_URL", "sqlite:///ecoeats.db"))
+        keys = db.purge_kv_store()
+        print(f"✅ Удалено просроченных записей: {keys}")
+    
     else:
         print("❌ Неизвестная команда")
 
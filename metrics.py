@@ -0,0 +1,355 @@
+"""
+Метрики EcoEats в формате Prometheus
+
+Небольшой реестр без внешних зависимостей: Counter, Gauge и Histogram с
+метками и вывод в текстовом формате Prometheus (эндпоинт /metrics в api.py).
+
+Метрики бота (обработчики aiogram) — в bot_metrics.py.
+
+MetricsMiddleware (ASGI) считает для каждого обработчика FastAPI число
+запросов, время ответа, запросы в работе и время, проведённое в БД.
+Время БД накапливает AsyncDatabaseService._run через record_db_time: оно
+пишется и в гистограмму по методам DatabaseService, и в счётчик текущего
+запроса (contextvar), если вызов сделан внутри запроса.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# === РЕЕСТР ===
+class Registry:
+    """Набор метрик, выводимых вместе"""
+
+    def __init__(self):
+        self._metrics: Dict[str, "_Metric"] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: "_Metric"):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional["_Metric"]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# === МЕТРИКИ ===
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Метрика с конкретными значениями меток"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name}: labels required")
+        return self.labels()
+
+    def items(self) -> List[Tuple[Tuple[str, ...], object]]:
+        return list(self._children.items())
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик"""
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def samples(self) -> Iterator[str]:
+        for values, child in self.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(_Metric):
+    """Текущее значение; set_function — вычислять при выводе
+    Для метрики с одной меткой функция может вернуть {значение метки: число}.
+    """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function: Optional[Callable[[], float]] = None
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def get(self) -> float:
+        """Текущее значение метрики без меток"""
+        if self._function is not None:
+            return self._function()
+        return self._default().value
+
+    def samples(self) -> Iterator[str]:
+        if self._function is not None:
+            value = self._function()
+            if isinstance(value, dict):
+                for label, item in value.items():
+                    yield f"{self.name}{_format_labels(self.labelnames, (str(label),))} {_format_value(item)}"
+            else:
+                yield f"{self.name} {_format_value(value)}"
+            return
+        for values, child in self.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """Копия (счётчики бакетов, сумма, число) для расчёта приращений"""
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q: float) -> float:
+        return estimate_quantile(self.buckets, self.counts, q)
+
+
+def estimate_quantile(buckets: Sequence[float], counts: Sequence[int], q: float) -> float:
+    """Оценка квантиля по счётчикам бакетов (верхняя граница бакета)"""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for bound, count in zip(tuple(buckets) + (float("inf"),), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+class Histogram(_Metric):
+    """Распределение значений по бакетам (секунды)"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def samples(self) -> Iterator[str]:
+        for values, child in self.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+# === ВРЕМЯ ВНУТРИ ЗАПРОСА ===
+class TimeAccumulator:
+    """Время, накопленное внутри текущего контекста (HTTP-запрос, апдейт бота)"""
+
+    def __init__(self, name: str):
+        self._var: ContextVar[Optional[List[float]]] = ContextVar(f"ecoeats_{name}_time", default=None)
+
+    @contextmanager
+    def scope(self) -> Iterator[List[float]]:
+        """Считать время внутри блока; накопленное значение — в [0]"""
+        holder = [0.0]
+        token = self._var.set(holder)
+        try:
+            yield holder
+        finally:
+            self._var.reset(token)
+
+    def add(self, seconds: float):
+        holder = self._var.get()
+        if holder is not None:
+            holder[0] += seconds
+
+
+DB_CALL_SECONDS = Histogram(
+    "ecoeats_db_call_duration_seconds",
+    "Время вызова метода DatabaseService, включая ожидание пула потоков",
+    ["method"],
+)
+DB_PENDING = Gauge(
+    "ecoeats_db_pending_calls",
+    "Вызовов БД в пуле потоков (ожидают или выполняются)",
+)
+DB_TIME = TimeAccumulator("db")
+
+
+def db_time_scope():
+    """Считать время БД внутри блока"""
+    return DB_TIME.scope()
+
+
+def record_db_time(method: str, seconds: float):
+    """Учесть вызов метода БД"""
+    DB_CALL_SECONDS.labels(method).observe(seconds)
+    DB_TIME.add(seconds)
+
+
+# === HTTP ===
+HTTP_REQUESTS = Counter(
+    "ecoeats_http_requests_total",
+    "Число HTTP-запросов по обработчику, методу и статусу",
+    ["handler", "method", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "ecoeats_http_request_duration_seconds",
+    "Время ответа по обработчику",
+    ["handler"],
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    "ecoeats_http_request_db_seconds",
+    "Время в БД за один запрос по обработчику",
+    ["handler"],
+)
+HTTP_IN_FLIGHT = Gauge(
+    "ecoeats_http_requests_in_flight",
+    "HTTP-запросов в обработке",
+)
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: метрики запросов по обработчикам FastAPI.
+
+    Метка handler — имя функции-эндпоинта (не URL), поэтому число рядов не
+    зависит от параметров пути; запросы без маршрута попадают в "unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            with db_time_scope() as db_time:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec()
+            endpoint = scope.get("endpoint")
+            handler = getattr(endpoint, "__name__", None) or "unmatched"
+            HTTP_REQUESTS.labels(handler, scope["method"], status[0]).inc()
+            HTTP_REQUEST_SECONDS.labels(handler).observe(elapsed)
+            HTTP_REQUEST_DB_SECONDS.labels(handler).observe(db_time[0])
@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Boolean, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from db_engine import create_db_engine, sqlite_url
 
 Base = declarative_base()
 
@@ -9,13 +10,19 @@ class User(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, index=True)
+    telegram_id = Column(BigInteger, unique=True, index=True)  # ID Telegram не помещаются в int32
     username = Column(String(255), nullable=True)
     eco_points = Column(Integer, default=0)
     orders_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     orders = relationship("Order", back_populates="user")
+    stats = relationship("UserStats", uselist=False, back_populates="user")
+    
+    __table_args__ = (
+        # Топ рейтинга EcoPoints читается по индексу без сортировки всех пользователей
+        Index("ix_users_eco_points_rank", eco_points.desc(), id),
+    )
     
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id}, eco_points={self.eco_points})>"
@@ -64,6 +71,11 @@ class Order(Base):
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
     
+    __table_args__ = (
+        # История заказов пользователя: постраничная выборка по (created_at, id)
+        Index("ix_orders_user_created", user_id, created_at, id),
+    )
+    
     def __repr__(self):
         return f"<Order(id={self.id}, user_id={self.user_id}, total={self.total_amount})>"
 
@@ -99,9 +111,76 @@ class EcoPoint(Base):
         return f"<EcoPoint(user_id={self.user_id}, amount={self.amount}, reason={self.reason})>"
 
 
+class UserStats(Base):
+    """Агрегаты по заказам пользователя, обновляются вместе с заказом"""
+    __tablename__ = "user_stats"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total_orders = Column(Integer, default=0)
+    total_spent = Column(Float, default=0)  # блюда + экосбор
+    eco_fee_paid = Column(Float, default=0)
+    eco_items = Column(Integer, default=0)  # позиций в экоупаковке
+    last_order_at = Column(DateTime, nullable=True)
+    
+    user = relationship("User", back_populates="stats")
+    
+    def __repr__(self):
+        return f"<UserStats(user_id={self.user_id}, total_orders={self.total_orders})>"
+
+
+class KVEntry(Base):
+    """Общее хранилище ключ-значение: корзины и FSM-состояния бота"""
+    __tablename__ = "kv_store"
+    
+    key = Column(String(255), primary_key=True)
+    value = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True, index=True)  # NULL — бессрочно
+    
+    def __repr__(self):
+        return f"<KVEntry(key={self.key})>"
+
+
+class IdempotencyKey(Base):
+    """Результаты операций по ключу идемпотентности (повторы запросов)"""
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String(255), primary_key=True)
+    scope = Column(String(50), nullable=False)
+    result = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<IdempotencyKey(key={self.key}, scope={self.scope})>"
+
+
+class Broadcast(Base):
+    """Рассылка всем пользователям и её прогресс (для продолжения после сбоя)"""
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), nullable=True)
+    status = Column(String(20), default="pending")  # pending, running, completed, cancelled
+    recipients = Column(Integer, default=0)  # пользователей на момент создания
+    max_user_id = Column(Integer, nullable=True)  # users.id последнего получателя: позже пришедшие не получают
+    last_user_id = Column(Integer, default=0)  # users.id последнего обработанного получателя
+    delivered = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<Broadcast(id={self.id}, status={self.status}, delivered={self.delivered})>"
+
+
 # Инициализация базы данных
-def init_db(db_path: str = "ecoeats.db"):
-    """Инициализирует базу данных и создает таблицы"""
-    engine = create_engine(f"sqlite:///{db_path}", echo=False)
+def init_db(db_path: str = "ecoeats.db", db_url: str = None):
+    """Инициализирует базу данных и создает таблицы
+    db_url: полный URL БД (например, postgresql://...), иначе SQLite-файл db_path
+    """
+    engine = create_db_engine(db_url or sqlite_url(db_path))
     Base.metadata.create_all(engine)
     return engine
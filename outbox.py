@@ -0,0 +1,389 @@
+"""
+Очередь исходящих сообщений бота с учётом лимитов Telegram
+
+Обработчики не ждут Bot API: send_message / edit_text ставят запрос в
+очередь и сразу возвращают Future. Отправка идёт в фоне с максимальной
+разрешённой скоростью:
+- общий лимит бота и лимит на чат (token bucket);
+- сообщения одного чата уходят по порядку, по одному;
+- ответ 429 (TelegramRetryAfter) приостанавливает чат на retry_after
+  секунд, запрос повторяется;
+- сетевые ошибки и 5xx повторяются с экспоненциальной задержкой;
+- несколько ещё не отправленных правок одного сообщения склеиваются в
+  одну (уходит последний текст);
+- «message is not modified» считается успехом;
+- ответы на нажатия кнопок (answerCallbackQuery) не сообщения чату: они
+  идут каждый своей очередью, без лимитов на чат и на бота, но с теми же
+  повторами после 429 и сетевых ошибок;
+- массовые сообщения (bulk=True, рассылки) уходят, только когда нет
+  готовых к отправке ответов пользователям: рассылка делит лимит бота
+  с ответами и забирает только свободную его часть.
+
+Ошибки не теряются молча: они пишутся в лог и в метрики (metrics.py).
+Запрос отправляется в контексте (contextvars), где его поставили в очередь,
+поэтому метрики Bot API по обработчикам (bot_metrics.py) учитывают и его.
+
+Переменные окружения:
+- OUTBOX_GLOBAL_RATE     — запросов в секунду на бота (30; 0 — без лимита)
+- OUTBOX_CHAT_RATE       — запросов в секунду на чат (1; 0 — без лимита)
+- OUTBOX_CHAT_BURST      — запросов в чат подряд без ожидания (3)
+- OUTBOX_MAX_CONCURRENCY — одновременных запросов к Bot API (16)
+- OUTBOX_MAX_RETRIES     — повторов одного запроса (5)
+- OUTBOX_DRAIN_TIMEOUT   — секунд на отправку очереди при остановке (10)
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage, TelegramMethod
+from aiogram.types import CallbackQuery, Message
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_QUEUED = Gauge("ecoeats_outbox_queued", "Запросов в очереди исходящих (включая отправляемые)")
+OUTBOX_SENT = Counter("ecoeats_outbox_sent_total", "Отправленные запросы", ["method"])
+OUTBOX_FAILED = Counter("ecoeats_outbox_failed_total", "Запросы, которые не удалось отправить", ["method", "error"])
+OUTBOX_RETRY_AFTER = Counter("ecoeats_outbox_retry_after_total", "Ответы 429 (flood control)")
+OUTBOX_COALESCED = Counter("ecoeats_outbox_coalesced_total", "Правки, заменённые более новой правкой")
+OUTBOX_WAIT_SECONDS = Histogram("ecoeats_outbox_wait_seconds", "Время от постановки в очередь до отправки")
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst в запасе; rate <= 0 — без лимита"""
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Секунд до появления токена"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _Job:
+    method: TelegramMethod
+    enqueued_at: float
+    futures: List[asyncio.Future] = field(default_factory=list)
+    edit_key: Optional[Tuple[int, int]] = None
+    fallback: Optional[TelegramMethod] = None  # отправить вместо правки, если править нельзя
+    attempts: int = 0
+    bulk: bool = False
+    limited: bool = True  # учитывать лимиты на чат и на бота
+    context: Optional[contextvars.Context] = None  # контекст постановки в очередь
+
+
+def _consume_exception(future: asyncio.Future):
+    # Ошибку уже записали в лог; без этого asyncio ругается на непрочитанное исключение
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Фоновая отправка запросов к Bot API с лимитами и повторами"""
+
+    def __init__(self, bot: Bot, global_rate: float = None, chat_rate: float = None, chat_burst: float = None,
+                 max_concurrency: int = None, max_retries: int = None):
+        if global_rate is None:
+            global_rate = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+        if chat_rate is None:
+            chat_rate = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+        if chat_burst is None:
+            chat_burst = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("OUTBOX_MAX_CONCURRENCY", "16"))
+        if max_retries is None:
+            max_retries = int(os.getenv("OUTBOX_MAX_RETRIES", "5"))
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.queued = 0
+
+        self._global = TokenBucket(global_rate, burst=max(global_rate, 1))
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until: Dict[int, float] = {}
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._edits: Dict[Tuple[int, int], _Job] = {}
+        self._heap: List[Tuple[float, int, int]] = []  # (когда можно отправлять, порядок, chat_id)
+        self._bulk_heap: List[Tuple[float, int, int]] = []  # то же для чатов с массовыми сообщениями
+        self._scheduled = set()
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._send_tasks = set()
+        OUTBOX_QUEUED.set_function(lambda: self.queued)
+
+    # === ПОСТАНОВКА В ОЧЕРЕДЬ ===
+    def send(self, chat_id: Any, method: TelegramMethod, edit_key: Tuple[int, int] = None,
+             fallback: TelegramMethod = None, bulk: bool = False, limited: bool = True) -> asyncio.Future:
+        """Поставить запрос в очередь чата; Future получит результат Bot API
+        chat_id: ключ очереди — ID чата (или другой ключ для limited=False)
+        bulk: массовое сообщение, отправляется после ответов пользователям
+        limited: учитывать лимиты на чат и на бота
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+
+        pending = self._edits.get(edit_key) if edit_key else None
+        if pending is not None:
+            # Предыдущая правка ещё не ушла: отправим только последнюю
+            pending.method = method
+            pending.fallback = fallback
+            pending.futures.append(future)
+            OUTBOX_COALESCED.inc()
+            return future
+
+        job = _Job(method=method, enqueued_at=time.monotonic(), futures=[future],
+                   edit_key=edit_key, fallback=fallback, bulk=bulk, limited=limited,
+                   context=contextvars.copy_context())
+        if edit_key:
+            self._edits[edit_key] = job
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self.queued += 1
+        self._idle.clear()
+        self._schedule(chat_id, time.monotonic())
+        if self._loop_task is None:
+            self.start()
+        return future
+
+    def send_message(self, chat_id: int, text: str, bulk: bool = False, **kwargs: Any) -> asyncio.Future:
+        return self.send(chat_id, SendMessage(chat_id=chat_id, text=text, **kwargs), bulk=bulk)
+
+    def answer(self, message: Message, text: str, **kwargs: Any) -> asyncio.Future:
+        """Аналог message.answer через очередь"""
+        return self.send_message(message.chat.id, text, **kwargs)
+
+    def edit_text(self, message: Message, text: str, fallback: bool = False, **kwargs: Any) -> asyncio.Future:
+        """Аналог message.edit_text через очередь
+        fallback: если сообщение нельзя изменить, отправить новое
+        """
+        chat_id = message.chat.id
+        return self.send(
+            chat_id,
+            EditMessageText(chat_id=chat_id, message_id=message.message_id, text=text, **kwargs),
+            edit_key=(chat_id, message.message_id),
+            fallback=SendMessage(chat_id=chat_id, text=text, **kwargs) if fallback else None,
+        )
+
+    def answer_callback(self, callback: CallbackQuery, text: str = None, **kwargs: Any) -> asyncio.Future:
+        """Аналог callback.answer через очередь (без лимитов, с повторами)"""
+        return self.send(
+            ("callback", callback.id),
+            AnswerCallbackQuery(callback_query_id=callback.id, text=text, **kwargs),
+            limited=False,
+        )
+
+    # === ПЛАНИРОВЩИК ===
+    def _schedule(self, chat_id: int, at: float):
+        if chat_id in self._scheduled or chat_id in self._in_flight:
+            return
+        # Приоритет чата определяет первый запрос в его очереди
+        heap = self._bulk_heap if self._queues[chat_id][0].bulk else self._heap
+        heapq.heappush(heap, (at, next(self._seq), chat_id))
+        self._scheduled.add(chat_id)
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_heap(self, now: float) -> List[Tuple[float, int, int]]:
+        """Очередь, из которой отправлять: массовые сообщения — только если
+        среди обычных нет готовых раньше"""
+        if not self._bulk_heap:
+            return self._heap
+        if self._heap and (self._heap[0][0] <= now or self._heap[0][0] <= self._bulk_heap[0][0]):
+            return self._heap
+        return self._bulk_heap
+
+    async def _run(self):
+        while True:
+            if not self._heap and not self._bulk_heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            heap = self._next_heap(now)
+            ready_at, _, chat_id = heap[0]
+            wait = ready_at - now
+            if wait <= 0:
+                limited = self._queues[chat_id][0].limited
+                wait = self._paused_until.get(chat_id, 0) - now
+                if limited:
+                    wait = max(wait, self._chat_bucket(chat_id).delay(now))
+                if wait > 0:
+                    heapq.heapreplace(heap, (now + wait, next(self._seq), chat_id))
+                    continue
+                wait = self._global.delay(now) if limited else 0
+                if wait <= 0:
+                    await self._slots.acquire()
+                    heapq.heappop(heap)
+                    self._scheduled.discard(chat_id)
+                    self._start_send(chat_id)
+                    continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_send(self, chat_id: int):
+        job = self._queues[chat_id].popleft()
+        if job.edit_key and self._edits.get(job.edit_key) is job:
+            del self._edits[job.edit_key]
+        if all(future.cancelled() for future in job.futures):
+            # Результат никому не нужен (например, рассылку остановили)
+            self._done()
+            self._slots.release()
+            self._after_send(chat_id)
+            return
+        if job.limited:
+            now = time.monotonic()
+            self._chat_bucket(chat_id).take(now)
+            self._global.take(now)
+        self._in_flight.add(chat_id)
+        task = asyncio.create_task(self._send(chat_id, job), context=job.context)
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, chat_id: int, job: _Job):
+        method_name = type(job.method).__name__
+        if not job.attempts:
+            OUTBOX_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at)
+        retry_in = None
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            OUTBOX_RETRY_AFTER.inc()
+            logger.warning(f"Flood control в чате {chat_id}: пауза {e.retry_after} с")
+            retry_in = e.retry_after
+        except TelegramBadRequest as e:
+            if "message is not modified" in e.message:
+                self._finish(job, result=True)
+            elif job.fallback is not None:
+                job.method, job.fallback = job.fallback, None
+                retry_in = 0
+            else:
+                self._fail(job, method_name, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            retry_in = min(2 ** job.attempts, 30)
+            logger.warning(f"Ошибка отправки {method_name} в чат {chat_id}: {e}; повтор через {retry_in} с")
+        except Exception as e:
+            self._fail(job, method_name, e)
+        else:
+            OUTBOX_SENT.labels(method_name).inc()
+            self._finish(job, result=result)
+        finally:
+            if retry_in is not None:
+                job.attempts += 1
+                if job.attempts > self.max_retries:
+                    self._fail(job, method_name, RuntimeError(f"Retries exhausted after {job.attempts} attempts"))
+                else:
+                    if retry_in:
+                        self._paused_until[chat_id] = time.monotonic() + retry_in
+                    self._queues[chat_id].appendleft(job)
+            self._in_flight.discard(chat_id)
+            self._slots.release()
+            self._after_send(chat_id)
+
+    def _after_send(self, chat_id: int):
+        if self._queues.get(chat_id):
+            self._schedule(chat_id, time.monotonic())
+            return
+        # Чат без очереди: освобождаем его состояние, если лимит уже восстановился
+        self._queues.pop(chat_id, None)
+        now = time.monotonic()
+        if self._paused_until.get(chat_id, 0) <= now:
+            self._paused_until.pop(chat_id, None)
+        if len(self._chat_buckets) > 10000:
+            for idle_chat in [cid for cid, bucket in self._chat_buckets.items()
+                              if cid not in self._queues and bucket.is_full(now)]:
+                del self._chat_buckets[idle_chat]
+        self._wakeup.set()
+
+    def _finish(self, job: _Job, result: Any = None):
+        for future in job.futures:
+            if not future.done():
+                future.set_result(result)
+        self._done()
+
+    def _fail(self, job: _Job, method_name: str, error: Exception):
+        OUTBOX_FAILED.labels(method_name, type(error).__name__).inc()
+        logger.error(f"Не удалось отправить {method_name}: {error}")
+        for future in job.futures:
+            if not future.done():
+                future.set_exception(error)
+        self._done()
+
+    def _done(self):
+        self.queued -= 1
+        if not self.queued:
+            self._idle.set()
+
+    # === ЗАПУСК И ОСТАНОВКА ===
+    def start(self):
+        """Запустить фоновую отправку"""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = None):
+        """Отправить накопленное (не дольше timeout секунд) и остановиться"""
+        if timeout is None:
+            timeout = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "10"))
+        if self.queued:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не отправлено при остановке: {self.queued} запросов")
+        if self._loop_task:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        for task in list(self._send_tasks):
+            task.cancel()
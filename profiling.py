@@ -0,0 +1,244 @@
+"""
+Профилирование SQL-запросов DatabaseService
+
+QueryProfiler подписывается на события движка SQLAlchemy и для каждого
+запроса запоминает «отпечаток» (текст без литералов и с одним ? вместо
+списков IN/VALUES), число выполнений и время. Если публичные методы
+DatabaseService обёрнуты через profile_service, запросы группируются по
+методу: сколько вызовов, запросов на вызов, суммарное время и p95.
+
+Признак N+1: внутри одного вызова метода один и тот же отпечаток выполнен
+не меньше n_plus_one_threshold раз (executemany считается одним запросом).
+
+Включается переменной окружения DB_PROFILE=1 (см. DatabaseService) или
+вручную:
+
+    profiler = profile_service(db)
+    ...
+    print(profiler.format_report())
+"""
+
+import functools
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),                       # строки
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),                     # числа
+    (re.compile(r"%\(\w+\)s|:\w+|\$\d+|%s"), "?"),               # параметры драйверов
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),          # IN (?, ?, ...)
+    (re.compile(r"(VALUES\s*\(\?\))(?:\s*,\s*\(\?\))+", re.I), r"\1"),  # VALUES (?), (?)
+    (re.compile(r"\s+"), " "),
+]
+
+
+def fingerprint(statement: str) -> str:
+    """Текст запроса без литералов: одинаковый для запросов, различающихся только значениями"""
+    result = statement
+    for pattern, replacement in _LITERALS:
+        result = pattern.sub(replacement, result)
+    return result.strip()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..1) по ближайшему рангу; 0 для пустого списка"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class _Stats:
+    """Число, сумма и выборка длительностей для p95
+    Хранится не больше RESERVOIR_SIZE длительностей (reservoir sampling),
+    поэтому память не растёт при долгой работе с DB_PROFILE=1.
+    """
+    __slots__ = ("count", "total", "durations")
+
+    RESERVOIR_SIZE = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.durations: List[float] = []
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if len(self.durations) < self.RESERVOIR_SIZE:
+            self.durations.append(seconds)
+        else:
+            index = random.randrange(self.count)
+            if index < self.RESERVOIR_SIZE:
+                self.durations[index] = seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "p95_ms": round(percentile(self.durations, 0.95) * 1000, 3),
+        }
+
+
+class _Call:
+    """Запросы одного вызова метода"""
+    __slots__ = ("method", "statements")
+
+    def __init__(self, method: str):
+        self.method = method
+        self.statements: Dict[str, int] = {}
+
+
+class QueryProfiler:
+    """Статистика SQL-запросов движка по отпечаткам и методам DatabaseService"""
+
+    def __init__(self, engine, n_plus_one_threshold: int = 5):
+        self.engine = engine
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._lock = threading.Lock()
+        self._call: ContextVar[Optional[_Call]] = ContextVar("ecoeats_profiled_call", default=None)
+        self.reset()
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def reset(self):
+        with self._lock:
+            self.statement_count = 0
+            self.statements: Dict[str, _Stats] = {}
+            self.methods: Dict[str, _Stats] = {}
+            self.method_statements: Dict[str, Dict[str, _Stats]] = {}
+            self.n_plus_one: Dict[tuple, int] = {}
+
+    def close(self):
+        """Отписаться от событий движка"""
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+
+    # --- события движка ---
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("ecoeats_query_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["ecoeats_query_start"].pop()
+        key = fingerprint(statement)
+        call = self._call.get()
+        with self._lock:
+            self.statement_count += 1
+            self.statements.setdefault(key, _Stats()).add(elapsed)
+            if call is not None:
+                self.method_statements.setdefault(call.method, {}).setdefault(key, _Stats()).add(elapsed)
+        if call is not None:
+            call.statements[key] = call.statements.get(key, 0) + 1
+
+    # --- методы DatabaseService ---
+    def wrap(self, name: str, func):
+        """Обернуть метод: запросы внутри него учитываются на его имя"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self._call.get() is not None:
+                # Вложенный вызов (add_eco_points -> add_eco_points_bulk) учитывается внешним
+                return func(*args, **kwargs)
+            call = _Call(name)
+            token = self._call.set(call)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                self._call.reset(token)
+                self._finish_call(call, elapsed)
+
+        return wrapper
+
+    def _finish_call(self, call: _Call, elapsed: float):
+        new_flags = []
+        with self._lock:
+            self.methods.setdefault(call.method, _Stats()).add(elapsed)
+            for key, count in call.statements.items():
+                if count < self.n_plus_one_threshold:
+                    continue
+                flag = (call.method, key)
+                if flag not in self.n_plus_one:
+                    new_flags.append((key, count))
+                self.n_plus_one[flag] = max(self.n_plus_one.get(flag, 0), count)
+        for key, count in new_flags:
+            logger.warning(f"Возможный N+1 в {call.method}: {count} одинаковых запросов за вызов: {key[:200]}")
+
+    # --- отчёт ---
+    def report(self, top: int = 20) -> dict:
+        """Отчёт: методы, самые дорогие запросы и подозрения на N+1"""
+        with self._lock:
+            methods = {}
+            for name, stats in sorted(self.methods.items(), key=lambda item: item[1].total, reverse=True):
+                statements = self.method_statements.get(name, {})
+                methods[name] = {
+                    **stats.to_dict(),
+                    "statements_per_call": round(sum(s.count for s in statements.values()) / stats.count, 2),
+                    "statements": [
+                        {"sql": key, **s.to_dict()}
+                        for key, s in sorted(statements.items(), key=lambda item: item[1].total, reverse=True)
+                    ],
+                }
+            return {
+                "statements_total": self.statement_count,
+                "methods": methods,
+                "top_statements": [
+                    {"sql": key, **stats.to_dict()}
+                    for key, stats in sorted(self.statements.items(), key=lambda item: item[1].total,
+                                             reverse=True)[:top]
+                ],
+                "n_plus_one": [
+                    {"method": method, "sql": key, "max_per_call": count}
+                    for (method, key), count in sorted(self.n_plus_one.items(), key=lambda item: -item[1])
+                ],
+            }
+
+    def format_report(self, top: int = 10) -> str:
+        """Отчёт в текстовом виде"""
+        report = self.report(top)
+        lines = [f"SQL-запросов: {report['statements_total']}", "", "Методы (по суммарному времени):"]
+        for name, stats in report["methods"].items():
+            lines.append(
+                f"  {name}: {stats['count']} вызовов, {stats['statements_per_call']} запросов/вызов, "
+                f"всего {stats['total_ms']} мс, p95 {stats['p95_ms']} мс"
+            )
+        lines += ["", "Самые дорогие запросы:"]
+        for stats in report["top_statements"]:
+            lines.append(f"  {stats['count']}x, всего {stats['total_ms']} мс, p95 {stats['p95_ms']} мс: "
+                         f"{stats['sql'][:160]}")
+        if report["n_plus_one"]:
+            lines += ["", "Возможные N+1:"]
+            for item in report["n_plus_one"]:
+                lines.append(f"  {item['method']}: до {item['max_per_call']} раз за вызов: {item['sql'][:160]}")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        """Сохранить отчёт в JSON"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+
+
+def profile_service(db, n_plus_one_threshold: int = 5, exclude=("get_session",)) -> QueryProfiler:
+    """Включить профилирование для экземпляра DatabaseService
+    Публичные методы экземпляра оборачиваются, класс не меняется.
+    """
+    profiler = QueryProfiler(db.engine, n_plus_one_threshold)
+    for name in dir(type(db)):
+        if name.startswith("_") or name in exclude:
+            continue
+        attribute = getattr(db, name)
+        if callable(attribute) and not isinstance(attribute, type):
+            setattr(db, name, profiler.wrap(name, attribute))
+    return profiler
@@ -0,0 +1,492 @@
+"""
+Хранилища состояния бота: корзины пользователей и FSM
+
+Бэкенд выбирается переменной окружения STORAGE_BACKEND:
+- sql    — таблица kv_store в основной БД (по умолчанию)
+- redis  — Redis по адресу REDIS_URL (нужен пакет redis);
+           REDIS_URL=fake:// включает встроенный FakeRedis для тестов
+- memory — память процесса (данные теряются при перезапуске)
+
+Бэкенды sql и redis позволяют запускать несколько воркеров бота и
+перезапускать их без потери корзин.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import AsyncDatabaseService
+
+logger = logging.getLogger(__name__)
+
+
+# === ОГРАНИЧЕННЫЙ КЭШ ===
+class BoundedCache:
+    """LRU-словарь с ограничением числа записей и временем простоя.
+
+    Записи хранятся в порядке последнего обращения, поэтому и вытеснение по
+    размеру, и очистка простаивающих записей снимают элементы с начала без
+    полного обхода.
+    """
+
+    def __init__(self, max_entries: int, idle_ttl: float, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        self._data: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default=None):
+        entry = self._data.get(key)
+        now = self._clock()
+        if entry is None or now - entry[1] > self.idle_ttl:
+            if entry is not None:
+                del self._data[key]
+                self.evicted_ttl += 1
+            self.misses += 1
+            return default
+        self._data[key] = (entry[0], now)
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any):
+        now = self._clock()
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+        self.purge_expired(now)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted_lru += 1
+
+    def pop(self, key: str, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def purge_expired(self, now: float = None):
+        """Удалить записи, простаивающие дольше idle_ttl"""
+        if now is None:
+            now = self._clock()
+        while self._data:
+            key, (_, last_access) = next(iter(self._data.items()))
+            if now - last_access <= self.idle_ttl:
+                break
+            del self._data[key]
+            self.evicted_ttl += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+        }
+
+
+def _cart_limits() -> Tuple[int, float]:
+    """Лимиты хранения корзин из CART_MAX_ENTRIES и CART_IDLE_TTL (секунды)"""
+    return int(os.getenv("CART_MAX_ENTRIES", "100000")), float(os.getenv("CART_IDLE_TTL", "86400"))
+
+
+# === БЭКЕНДЫ КЛЮЧ-ЗНАЧЕНИЕ ===
+class KeyValueBackend(ABC):
+    """Минимальный интерфейс хранилища: чтение и запись пачкой, списки
+
+    shared — данные видны всем воркерам (нельзя буферизовать записи в процессе).
+    """
+    shared = True
+
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Значения по ключам; отсутствующие ключи не возвращаются"""
+
+    @abstractmethod
+    async def write_many(self, values: Dict[str, Optional[str]]) -> None:
+        """Записать пачку значений; None удаляет ключ"""
+
+    @abstractmethod
+    async def list_get(self, key: str) -> List[Any]:
+        """Элементы списка по ключу (пустой список, если ключа нет)"""
+
+    @abstractmethod
+    async def list_append(self, key: str, item: Any) -> None:
+        """Атомарно дописать элемент (JSON-совместимый) в список по ключу"""
+
+    async def list_clear(self, key: str) -> None:
+        await self.write_many({key: None})
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+
+class MemoryBackend(KeyValueBackend):
+    """Память процесса; брошенные записи вытесняются по LRU и времени простоя"""
+
+    shared = False
+
+    def __init__(self, max_entries: int = None, idle_ttl: float = None):
+        default_entries, default_ttl = _cart_limits()
+        self._data = BoundedCache(
+            max_entries if max_entries is not None else default_entries,
+            idle_ttl if idle_ttl is not None else default_ttl,
+        )
+
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        values = {}
+        for key in keys:
+            value = self._data.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    async def write_many(self, values: Dict[str, Optional[str]]) -> None:
+        for key, value in values.items():
+            if value is None:
+                self._data.pop(key)
+            else:
+                self._data.set(key, value)
+
+    async def list_get(self, key: str) -> List[Any]:
+        raw = self._data.get(key)
+        return json.loads(raw) if raw else []
+
+    async def list_append(self, key: str, item: Any) -> None:
+        # Между чтением и записью нет await — атомарно в пределах процесса
+        raw = self._data.get(key)
+        items = json.loads(raw) if raw else []
+        items.append(item)
+        self._data.set(key, json.dumps(items, separators=(",", ":")))
+
+    def stats(self) -> Dict[str, int]:
+        return self._data.stats()
+
+
+class SQLBackend(KeyValueBackend):
+    """Таблица kv_store в основной БД; пачка пишется одной транзакцией.
+
+    Ключи живут ttl секунд с последней записи (как в Redis): просроченные не
+    читаются, а удаляет их purge_kv_store (python manage.py purge-kv).
+    """
+
+    def __init__(self, db: AsyncDatabaseService, ttl: float = None):
+        self.db = db
+        self.ttl = ttl if ttl is not None else _cart_limits()[1]
+
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        return await self.db.kv_get_many(keys)
+
+    async def write_many(self, values: Dict[str, Optional[str]]) -> None:
+        await self.db.kv_write_many(values, self.ttl or None)
+
+    async def list_get(self, key: str) -> List[Any]:
+        raw = (await self.db.kv_get_many([key])).get(key)
+        return json.loads(raw) if raw else []
+
+    async def list_append(self, key: str, item: Any) -> None:
+        # Список хранится JSON-строкой; дописывание — один UPDATE (kv_append)
+        await self.db.kv_append(key, json.dumps(item, separators=(",", ":")), self.ttl or None)
+
+
+class RedisBackend(KeyValueBackend):
+    """Redis (redis.asyncio.Redis или совместимый клиент, например FakeRedis).
+
+    Ключи живут ttl секунд с последней записи, брошенные корзины удаляет сам Redis.
+    Списки — нативные списки Redis (RPUSH/LRANGE/DEL).
+    """
+
+    def __init__(self, client, ttl: float = None):
+        self.client = client
+        self.ttl = int(ttl if ttl is not None else _cart_limits()[1])
+
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        if not keys:
+            return {}
+        values = await self.client.mget(keys)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    async def write_many(self, values: Dict[str, Optional[str]]) -> None:
+        if not values:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            if value is None:
+                pipe.delete(key)
+            else:
+                pipe.set(key, value, ex=self.ttl or None)
+        await pipe.execute()
+
+    async def list_get(self, key: str) -> List[Any]:
+        return [json.loads(item) for item in await self.client.lrange(key, 0, -1)]
+
+    async def list_append(self, key: str, item: Any) -> None:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(key, json.dumps(item, separators=(",", ":")))
+        if self.ttl:
+            pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class FakeRedis:
+    """Подмножество API redis.asyncio.Redis в памяти процесса (для тестов)"""
+
+    def __init__(self, clock=time.monotonic):
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._clock = clock
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and self._clock() >= expires_at:
+            del self._data[key]
+            return None
+        return value
+
+    async def mget(self, keys: List[str]) -> List[Optional[str]]:
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key: str, value: str, ex: Optional[int] = None) -> bool:
+        self._data[key] = (value, self._clock() + ex if ex else None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    async def rpush(self, key: str, *values: str) -> int:
+        items = await self.get(key) or []
+        items.extend(values)
+        self._data[key] = (items, self._data[key][1] if key in self._data else None)
+        return len(items)
+
+    async def lrange(self, key: str, start: int, end: int) -> List[str]:
+        items = await self.get(key) or []
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        if key not in self._data:
+            return False
+        self._data[key] = (self._data[key][0], self._clock() + seconds)
+        return True
+
+    def pipeline(self, transaction: bool = True) -> "_FakePipeline":
+        return _FakePipeline(self)
+
+    async def close(self) -> None:
+        pass
+
+
+class _FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self._client = client
+        self._commands = []
+
+    def set(self, key: str, value: str, ex: Optional[int] = None) -> "_FakePipeline":
+        self._commands.append((self._client.set, (key, value, ex)))
+        return self
+
+    def delete(self, *keys: str) -> "_FakePipeline":
+        self._commands.append((self._client.delete, keys))
+        return self
+
+    def rpush(self, key: str, *values: str) -> "_FakePipeline":
+        self._commands.append((self._client.rpush, (key, *values)))
+        return self
+
+    def expire(self, key: str, seconds: int) -> "_FakePipeline":
+        self._commands.append((self._client.expire, (key, seconds)))
+        return self
+
+    async def execute(self) -> List[Any]:
+        commands, self._commands = self._commands, []
+        return [await command(*args) for command, args in commands]
+
+
+def create_backend(db: AsyncDatabaseService) -> KeyValueBackend:
+    """Создать бэкенд по STORAGE_BACKEND/REDIS_URL"""
+    name = os.getenv("STORAGE_BACKEND", "sql")
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sql":
+        return SQLBackend(db)
+    if name == "redis":
+        url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        if url.startswith("fake://"):
+            return RedisBackend(FakeRedis())
+        try:
+            from redis.asyncio import Redis
+        except ImportError:
+            raise ValueError("STORAGE_BACKEND=redis требует пакет redis (pip install redis)")
+        return RedisBackend(Redis.from_url(url, decode_responses=True))
+    raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+
+
+# === КОРЗИНЫ ===
+# Позиция корзины хранится компактно: (dish_id, eco_packaging). Название и цену
+# бот берёт из снимка меню при показе корзины.
+CartItem = Tuple[int, bool]
+
+
+def _encode_cart(cart: List[CartItem]) -> str:
+    return json.dumps([[dish_id, int(eco_packaging)] for dish_id, eco_packaging in cart], separators=(",", ":"))
+
+
+def _decode_item(item) -> CartItem:
+    # Поддержка старого формата: словарь с dish_id/eco_packaging
+    if isinstance(item, dict):
+        return item["dish_id"], bool(item.get("eco_packaging"))
+    return item[0], bool(item[1])
+
+
+def _decode_cart(raw: str) -> List[CartItem]:
+    return [_decode_item(item) for item in json.loads(raw)]
+
+
+class CartStore:
+    """Корзины пользователей.
+
+    По умолчанию каждое изменение сразу уходит в бэкенд атомарной операцией
+    (дописать позицию, удалить корзину), поэтому воркеры, делящие бэкенд,
+    видят корзины друг друга и не затирают чужие изменения.
+
+    Для одного процесса с STORAGE_BACKEND=memory можно включить буфер:
+    изменения копятся в процессе и записываются пачкой раз в flush_interval
+    секунд. Для общих бэкендов (sql, redis) буфер не включается.
+    """
+
+    def __init__(self, backend: KeyValueBackend, flush_interval: float = None, prefix: str = "cart:"):
+        self.backend = backend
+        if flush_interval is None:
+            flush_interval = float(os.getenv("CART_FLUSH_INTERVAL", "0"))
+        if flush_interval > 0 and backend.shared:
+            logger.warning("CART_FLUSH_INTERVAL работает только с STORAGE_BACKEND=memory, запись без буфера")
+            flush_interval = 0
+        self.flush_interval = flush_interval
+        self.prefix = prefix
+        self._dirty: Dict[str, Optional[List[CartItem]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+
+    async def get(self, user_id: int) -> List[CartItem]:
+        """Получить копию корзины пользователя"""
+        key = self._key(user_id)
+        if key in self._dirty:
+            return list(self._dirty[key] or [])
+        return [_decode_item(item) for item in await self.backend.list_get(key)]
+
+    async def add(self, user_id: int, dish_id: int, eco_packaging: bool):
+        """Добавить позицию в корзину"""
+        key = self._key(user_id)
+        if self.flush_interval <= 0:
+            await self.backend.list_append(key, [dish_id, int(bool(eco_packaging))])
+            return
+        cart = await self.get(user_id)
+        cart.append((dish_id, bool(eco_packaging)))
+        self._dirty[key] = cart
+
+    async def clear(self, user_id: int):
+        """Очистить корзину"""
+        key = self._key(user_id)
+        if self.flush_interval <= 0:
+            await self.backend.list_clear(key)
+        else:
+            self._dirty[key] = None
+
+    async def flush(self):
+        """Записать накопленные изменения в бэкенд (режим с буфером)"""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self.backend.write_many({
+                key: _encode_cart(cart) if cart else None
+                for key, cart in batch.items()
+            })
+        except Exception:
+            # Возвращаем пачку в буфер, не затирая более свежие изменения
+            for key, cart in batch.items():
+                self._dirty.setdefault(key, cart)
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        """Метрики хранилища: размер буфера и вытеснения бэкенда"""
+        return {"pending_writes": len(self._dirty), **self.backend.stats()}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи корзин: {e}")
+
+    def start(self):
+        """Запустить фоновую запись буфера"""
+        if self.flush_interval > 0 and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Остановить фоновую запись и сбросить буфер"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+# === FSM ===
+class KVStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх KeyValueBackend"""
+
+    def __init__(self, backend: KeyValueBackend, prefix: str = "fsm:"):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _key(self, key: StorageKey, part: str) -> str:
+        return f"{self.prefix}{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.destiny}:{part}"
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self.backend.write_many({self._key(key, "state"): value})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        name = self._key(key, "state")
+        return (await self.backend.get_many([name])).get(name)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        value = json.dumps(data, ensure_ascii=False) if data else None
+        await self.backend.write_many({self._key(key, "data"): value})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        name = self._key(key, "data")
+        raw = (await self.backend.get_many([name])).get(name)
+        return json.loads(raw) if raw else {}
+
+    async def close(self) -> None:
+        await self.backend.close()
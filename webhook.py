@@ -0,0 +1,173 @@
+"""
+Webhook-режим бота EcoEats (aiohttp)
+
+Telegram присылает апдейты POST-запросами, поэтому нет лишнего long-poll
+запроса на каждую пачку, а несколько реплик бота можно поставить за
+балансировщик. Корзины и FSM при этом должны храниться вне процесса
+(STORAGE_BACKEND=sql или redis).
+
+Переменные окружения:
+- WEBHOOK_URL             — публичный URL, который регистрируется в Telegram
+- WEBHOOK_PATH            — путь обработчика (по умолчанию /webhook)
+- WEBHOOK_SECRET          — секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+- WEBHOOK_HOST/PORT       — адрес HTTP-сервера (0.0.0.0:8080)
+- WEBHOOK_MAX_CONCURRENCY — апдейтов, обрабатываемых одновременно
+- WEBHOOK_MAX_PENDING     — апдейтов в работе, после которых отвечаем 503
+                            (Telegram повторит доставку позже)
+- WEBHOOK_DRAIN_TIMEOUT   — секунд на завершение апдейтов при остановке
+- WEBHOOK_SET_ON_STARTUP  — регистрировать webhook при старте (true)
+- WEBHOOK_MAX_CONNECTIONS — параллельных соединений от Telegram (max_connections)
+"""
+
+import asyncio
+import logging
+import os
+import signal
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from bot_metrics import metrics_handler
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook с ограничением параллелизма и плавной остановкой.
+
+    Апдейт подтверждается сразу, а обрабатывается в фоне: одновременно не
+    больше max_concurrency, в работе не больше max_pending. Сверх лимита и во
+    время остановки отвечаем 503, и Telegram доставит апдейт повторно —
+    возможно, другой реплике.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        max_concurrency: int = 64,
+        max_pending: int = 1024,
+        drain_timeout: float = 30,
+        secret_token: Optional[str] = None,
+        **data: Any,
+    ) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def pending(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self._slots:
+            try:
+                await super()._background_feed_update(bot=bot, update=update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта: {e}")
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining or self.pending >= self.max_pending:
+            return web.Response(status=503, text="Service busy")
+        return await super().handle(request)
+
+    __call__ = handle
+
+    async def drain(self):
+        """Перестать принимать апдейты и дождаться обработки принятых"""
+        self.draining = True
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info(f"Ожидание завершения {len(tasks)} апдейтов...")
+        done, not_done = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if not_done:
+            logger.warning(f"Не успели обработать {len(not_done)} апдейтов за {self.drain_timeout} с")
+            for task in not_done:
+                task.cancel()
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        super().register(app, path=path, **kwargs)
+        app.on_cleanup.append(self._close_session)
+
+    async def close(self) -> None:
+        # Сессию бота здесь не закрываем: после этого хука диспетчер ещё
+        # отправляет очередь исходящих (on_shutdown бота), сессия закрывается
+        # в on_cleanup, когда все хуки остановки отработали
+        await self.drain()
+
+    async def _close_session(self, app: web.Application) -> None:
+        await super().close()
+
+
+def build_app(dispatcher: Dispatcher, bot: Bot, **data: Any) -> web.Application:
+    """Создать aiohttp-приложение с обработчиком webhook и проверкой здоровья"""
+    handler = BoundedRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        max_concurrency=int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64")),
+        max_pending=int(os.getenv("WEBHOOK_MAX_PENDING", "1024")),
+        drain_timeout=float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30")),
+        secret_token=os.getenv("WEBHOOK_SECRET") or None,
+        **data,
+    )
+
+    async def health(request: web.Request) -> web.Response:
+        # Во время остановки балансировщик должен снять реплику с трафика
+        if handler.draining:
+            return web.json_response({"status": "draining"}, status=503)
+        return web.json_response({"status": "healthy", "pending_updates": handler.pending})
+
+    app = web.Application()
+    app["webhook_handler"] = handler
+    app.router.add_get("/healthz", health)
+    app.router.add_get("/metrics", metrics_handler)
+    # Обработчик регистрируется раньше хуков диспетчера: при остановке сначала
+    # дожидаемся апдейтов, потом отправляем очередь исходящих, закрываем БД и
+    # хранилища и только затем сессию бота
+    handler.register(app, path=os.getenv("WEBHOOK_PATH", "/webhook"))
+    setup_application(app, dispatcher, bot=bot, **data)
+    return app
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot, **data: Any):
+    """Запустить HTTP-сервер webhook и работать до SIGINT/SIGTERM"""
+    app = build_app(dispatcher, bot, **data)
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url and os.getenv("WEBHOOK_SET_ON_STARTUP", "true").lower() in ("1", "true", "yes"):
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+        )
+        logger.info(f"🔗 Webhook зарегистрирован: {webhook_url}")
+
+    host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"🌐 Webhook-сервер слушает {host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        logger.info("🛑 Остановка webhook-сервера...")
+        # Сразу отвечаем 503 на новые апдейты и проверку здоровья
+        app["webhook_handler"].draining = True
+        await runner.cleanup()